@@ -0,0 +1,258 @@
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import make_plate, synthetic_nd2, use_stub_model
+
+# times every pipeline stage on a synthetic plate and writes the results as JSON, e.g.
+#   python benchmarks/run_benchmarks.py --frames 200 --size 512 --output bench.json
+#   python benchmarks/run_benchmarks.py --compare bench.json
+# times are from repeated untraced runs, peak memory from one extra run under tracemalloc
+
+
+def measure(func, repeats=3, setup=None, memory=True):
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    result = {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": float(np.median(seconds)),
+    }
+    if memory:
+        if setup is not None:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(
+    work_dir,
+    nframes=100,
+    nwells=2,
+    size=256,
+    ncells=30,
+    npulses=5,
+    repeats=3,
+    model="stub",
+    stages=None,
+    memory=True,
+):
+    from calcium_imaging_analysis.io import (
+        nd2_metadata_parse,
+        save_intermediate,
+        load_intermediate,
+        write_video,
+    )
+    from calcium_imaging_analysis.registration import _register_well, register_and_get_rois
+    from calcium_imaging_analysis.segmentation import segment
+    from calcium_imaging_analysis.traces import roi_pixel_index, roi_means, write_traces
+    from calcium_imaging_analysis.baseline import compute_dff0
+    from calcium_imaging_analysis.analysis import proc_photoswitch
+
+    nd2_fname = os.path.join(work_dir, "plate.nd2")
+    plate = make_plate(
+        nd2_fname,
+        nframes=nframes,
+        nwells=nwells,
+        shape=(size, size),
+        ncells=ncells,
+        npulses=npulses,
+    )
+    if model == "stub":
+        use_stub_model(plate["masks"])
+    well = plate["wells"][0]
+    output_dir = os.path.join(work_dir, "_analysis")
+    proc_fname = os.path.join(output_dir, f"{well}.h5")
+    register_kwargs = {"well_name": well, "experiment_type": "photoswitch", "roi_channel": ["mCherry"]}
+
+    def _clean():
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    results = {}
+    state = {}
+
+    def _run(stage, func, setup=None):
+        if (stages is not None) and (stage not in stages):
+            return
+        print(f"{stage}...", flush=True)
+        results[stage] = measure(func, repeats=repeats, setup=setup, memory=memory)
+        print(f"  {results[stage]['median']:.3f} s", flush=True)
+
+    with synthetic_nd2():
+        state["metadata"] = nd2_metadata_parse(nd2_fname)
+        _run("metadata", lambda: nd2_metadata_parse(nd2_fname))
+
+        def _register():
+            state["registered"] = _register_well(
+                nd2_fname, metadata=state["metadata"], **register_kwargs
+            )
+
+        _run("registration", _register, setup=_clean)
+        if "registered" not in state:
+            _clean()
+            _register()
+        _, data_dct, max_proj = state["registered"]
+
+        def _segment():
+            data_dct["roi_masks"] = segment(max_proj, model_type="cyto2", cache_dir=None)
+
+        _run("segmentation", _segment)
+        if "roi_masks" not in data_dct:
+            _segment()
+
+        def _save():
+            os.makedirs(output_dir, exist_ok=True)
+            save_intermediate(proc_fname, data_dct)
+
+        _run("save_intermediate", _save, setup=_clean)
+        _run(
+            "register_and_get_rois",
+            lambda: register_and_get_rois(
+                nd2_fname, metadata=state["metadata"], mask_cache_dir=None, **register_kwargs
+            ),
+            setup=_clean,
+        )
+
+        # everything below reads the intermediate written here
+        _clean()
+        _save()
+        frames = load_intermediate(proc_fname, channel=["mCherry"], lazy=True)["registered_frames"]
+        roi_index = roi_pixel_index(data_dct["roi_masks"])
+        values = roi_means(frames, roi_index)
+
+        _run("trace_extraction", lambda: roi_means(frames, roi_index))
+        _run("dff0_quantile", lambda: compute_dff0(values, method="quantile"))
+        _run(
+            "dff0_rolling_quantile",
+            lambda: compute_dff0(values, method="rolling_quantile", window=10),
+        )
+        traces = proc_photoswitch(proc_fname, force=True, trace_format="long")
+        parquet_fname = os.path.join(work_dir, "traces.parquet")
+        _run("write_traces", lambda: write_traces(traces, parquet_fname))
+        _run(
+            "proc_photoswitch",
+            lambda: proc_photoswitch(proc_fname, force=True),
+        )
+
+        clims = np.quantile(np.asarray(frames), [0.025, 0.995])
+        video_fname = os.path.join(work_dir, "video.mp4")
+        _run("write_video_stream", lambda: write_video(frames, video_fname, clims=clims, writer="stream"))
+        _run("write_video_preview", lambda: write_video(frames, video_fname, clims=clims, threads=1))
+
+    return results
+
+
+def compare(results, reference):
+    # median time and peak memory relative to an earlier run, >1 means slower/larger
+    print(f"{'stage':<24}{'time':>10}{'ratio':>8}{'peak MB':>10}{'ratio':>8}")
+    for _stage, _result in results["results"].items():
+        _ref = reference["results"].get(_stage)
+        time_ratio = _result["median"] / _ref["median"] if _ref else np.nan
+        peak = _result.get("peak_mb", np.nan)
+        peak_ratio = peak / _ref["peak_mb"] if (_ref and "peak_mb" in _ref) else np.nan
+        print(f"{_stage:<24}{_result['median']:>10.3f}{time_ratio:>8.2f}{peak:>10.1f}{peak_ratio:>8.2f}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on a synthetic plate")
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--wells", type=int, default=2)
+    parser.add_argument("--size", type=int, default=256, help="frame height and width")
+    parser.add_argument("--cells", type=int, default=30)
+    parser.add_argument("--pulses", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--model", default="stub", choices=["stub", "cellpose"], help="stub returns the true masks")
+    parser.add_argument("--stages", nargs="+", default=None, help="only run these stages")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--work-dir", default=None, help="default is a temporary directory")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run")
+    args = parser.parse_args(args)
+
+    params = {
+        "frames": args.frames,
+        "wells": args.wells,
+        "size": args.size,
+        "cells": args.cells,
+        "pulses": args.pulses,
+        "repeats": args.repeats,
+        "model": args.model,
+    }
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="cia_bench_")
+    try:
+        results = run_benchmarks(
+            work_dir,
+            nframes=args.frames,
+            nwells=args.wells,
+            size=args.size,
+            ncells=args.cells,
+            npulses=args.pulses,
+            repeats=args.repeats,
+            model=args.model,
+            stages=args.stages,
+            memory=not args.no_memory,
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "params": params,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=1)
+    else:
+        print(json.dumps(output, indent=1))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(output, json.load(f))
+    return output
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import types
+import numpy as np
+from contextlib import contextmanager
+from scipy.ndimage import shift as ndshift
+from skimage.draw import disk
+
+# synthetic plates that look like a photoswitch well scan to the pipeline: (T, P, C, Y, X)
+# uint16 stacks of round cells drifting with a known shift, known label masks and a
+# light-driven response in every pulse. SyntheticND2File stands in for nd2.ND2File so
+# metadata parsing, registration and lazy views run without real data
+
+_plates = {}
+
+
+def make_plate(
+    fname,
+    nframes=100,
+    nwells=2,
+    channels=["TRITC", "mCherry"],
+    shape=(256, 256),
+    ncells=30,
+    npulses=5,
+    max_drift=3.0,
+    seed=0,
+):
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    masks = np.zeros(shape, dtype="int32")
+    radius = max(3, min(shape) // 25)
+    for i in range(ncells):
+        rr, cc = disk(
+            (rng.uniform(2 * radius, height - 2 * radius), rng.uniform(2 * radius, width - 2 * radius)),
+            rng.uniform(0.7, 1.3) * radius,
+            shape=shape,
+        )
+        masks[rr, cc] = i + 1
+
+    # slow drift starting at zero, so the masks line up with the first (reference) frame
+    t = np.arange(nframes)
+    drift = max_drift * np.stack([np.sin(t / 15), 1 - np.cos(t / 20)], axis=1)
+
+    # every cell brightens at the start of each pulse and decays back
+    pulse_lens = np.diff(np.linspace(0, nframes, npulses + 1).astype("int"))
+    pulse_starts = np.cumsum(pulse_lens) - pulse_lens
+    response = np.zeros(nframes)
+    for _start, _len in zip(pulse_starts, pulse_lens):
+        response[_start : _start + _len] = np.exp(-np.arange(_len) / max(_len / 4, 1))
+    cell_gain = rng.uniform(0.5, 1.5, ncells + 1)
+    cell_gain[0] = 0
+
+    frames = np.empty((nframes, nwells, len(channels), height, width), dtype="uint16")
+    for _t in range(nframes):
+        for _well in range(nwells):
+            for _channel in range(len(channels)):
+                image = 100 + cell_gain[masks] * 400 * (1 + (_channel + 1) * response[_t])
+                image = ndshift(image, drift[_t], order=1, mode="nearest")
+                image += rng.normal(0, 10, shape)
+                frames[_t, _well, _channel] = np.clip(image, 0, 65535)
+
+    wells = [f"{chr(ord('A') + i // 12)}{i % 12 + 1:02d}" for i in range(nwells)]
+    events = [
+        {
+            "Time [s]": _t * 1.0 + _well * 0.1,
+            "T Index": _t,
+            "P Index": _well,
+            "Position Name": wells[_well],
+        }
+        for _t in range(nframes)
+        for _well in range(nwells)
+    ]
+    plate = {
+        "frames": frames,
+        "masks": masks,
+        "drift": drift,
+        "wells": wells,
+        "channels": list(channels),
+        "events": events,
+        "pulse_lens": [int(_) for _ in pulse_lens],
+    }
+    fname = os.path.abspath(fname)
+    _plates[fname] = plate
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, "w") as f:
+        f.write("synthetic plate, only readable through SyntheticND2File\n")
+    return plate
+
+
+class SyntheticND2File:
+    # the parts of nd2.ND2File the pipeline uses
+    def __init__(self, fname):
+        self.plate = _plates[os.path.abspath(fname)]
+        nframes, nwells, nchannels, height, width = self.plate["frames"].shape
+        self.sizes = {"T": nframes, "P": nwells, "C": nchannels, "Y": height, "X": width}
+        self.experiment = [
+            types.SimpleNamespace(
+                type="NETimeLoop",
+                parameters=types.SimpleNamespace(
+                    periods=[types.SimpleNamespace(count=_) for _ in self.plate["pulse_lens"]]
+                ),
+            ),
+            types.SimpleNamespace(
+                type="XYPosLoop",
+                parameters=types.SimpleNamespace(
+                    points=[types.SimpleNamespace(name=_) for _ in self.plate["wells"]]
+                ),
+            ),
+        ]
+        self.metadata = types.SimpleNamespace(
+            channels=[
+                types.SimpleNamespace(channel=types.SimpleNamespace(name=_))
+                for _ in self.plate["channels"]
+            ]
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def events(self):
+        return self.plate["events"]
+
+    def asarray(self):
+        return self.plate["frames"]
+
+    def to_dask(self):
+        import dask.array as da
+
+        frames = self.plate["frames"]
+        return da.from_array(frames, chunks=(1, 1) + frames.shape[2:])
+
+
+@contextmanager
+def synthetic_nd2():
+    # route nd2.ND2File to SyntheticND2File for the duration of the block
+    import nd2
+
+    original = nd2.ND2File
+    nd2.ND2File = SyntheticND2File
+    try:
+        yield
+    finally:
+        nd2.ND2File = original
+
+
+class StubModel:
+    # stands in for a cellpose model: returns the plate's true masks for projections of
+    # the plate's shape, otherwise labels everything above the 80th percentile
+    def __init__(self, masks=None):
+        self.masks = masks
+
+    def eval(self, projections, **kwargs):
+        from skimage.measure import label
+
+        def _segment(projection):
+            if (self.masks is not None) and (projection.shape == self.masks.shape):
+                return self.masks.copy()
+            return label(projection > np.quantile(projection, 0.8)).astype("int32")
+
+        if isinstance(projections, list):
+            return [_segment(_) for _ in projections], None, None, None
+        return _segment(projections), None, None, None
+
+
+def use_stub_model(masks=None, model_type="cyto2"):
+    # segmentation.get_model returns the stub instead of loading cellpose
+    from calcium_imaging_analysis import segmentation
+
+    segmentation._models[(model_type, "{}")] = StubModel(masks)
@@ -1,2 +1,3 @@
 import calcium_imaging_analysis.registration
-import calcium_imaging_analysis.io
\ No newline at end of file
+import calcium_imaging_analysis.io
+import calcium_imaging_analysis.traces
@@ -0,0 +1,272 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from urllib.parse import quote
+from calcium_imaging_analysis.traces import read_traces, compact_traces, metadata_key
+from calcium_imaging_analysis.io import find_intermediate, load_intermediate
+
+# hive-partitioned dataset of the per-file trace tables proc_* write next to the
+# intermediates (<session>/_analysis/<well>.parquet), laid out as
+#   <dataset>/session=<session>/experiment_type=<type>/well_sanitized=<well>/<source id>.parquet
+# every source file becomes one part file per partition, so adding a session only writes
+# that session's parts and re-ingesting a changed file only replaces its own parts. the
+# ingest log records the size/mtime of every source ingested, the schema of all parts is
+# kept in _common_metadata so readers never have to open every footer
+partition_columns = ["session", "experiment_type", "well_sanitized"]
+ingest_log_name = "_ingest_log.json"
+common_metadata_name = "_common_metadata"
+null_partition = "__HIVE_DEFAULT_PARTITION__"
+
+
+def find_trace_files(paths):
+    # per-file trace tables under directories (searched recursively), globs or files
+    if isinstance(paths, str):
+        paths = [paths]
+    trace_files = []
+    for _path in paths:
+        if os.path.isdir(_path):
+            trace_files += glob.glob(
+                os.path.join(_path, "**", "_analysis", "*.parquet"), recursive=True
+            )
+        elif os.path.isfile(_path):
+            trace_files.append(_path)
+        else:
+            trace_files += glob.glob(_path, recursive=True)
+    return sorted(set(os.path.abspath(_file) for _file in trace_files))
+
+
+def load_ingest_log(dataset_dir):
+    try:
+        with open(os.path.join(dataset_dir, ingest_log_name), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"sources": {}}
+
+
+def save_ingest_log(ingest_log, dataset_dir):
+    # same as the batch manifest, never leave a truncated log behind
+    fname = os.path.join(dataset_dir, ingest_log_name)
+    tmp_fname = f"{fname}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(ingest_log, f, indent=1)
+    os.replace(tmp_fname, fname)
+
+
+def source_experiment_type(fname, metadata={}):
+    # stored by proc_* since the aggregator exists, older files fall back to the intermediate
+    if "experiment_type" in metadata:
+        return metadata["experiment_type"]
+    proc_fname = find_intermediate(os.path.splitext(fname)[0])
+    if proc_fname is not None:
+        # no channel matches [], so no frames are read and the file is closed again
+        experiment_type = load_intermediate(proc_fname, channel=[]).get("experiment_type")
+        if experiment_type is not None:
+            return experiment_type
+    return "timecourse"
+
+
+def source_session(fname):
+    # same rule proc_* use to name figures, the directory holding _analysis
+    return os.path.dirname(os.path.normpath(fname)).split(os.path.sep)[-2]
+
+
+def partition_path(values):
+    return os.path.join(
+        *[
+            f"{_col}={null_partition if _value is None else quote(str(_value), safe='')}"
+            for _col, _value in zip(partition_columns, values)
+        ]
+    )
+
+
+def aggregate_traces(
+    paths,
+    dataset_dir,
+    experiment_type=None,  # overrides what the trace files/intermediates say
+    force=False,
+    prune=False,  # drop the parts of ingested sources that no longer exist
+    value_dtype="float32",
+):
+    # ingest new or changed trace files into dataset_dir, returns the sources ingested
+    # (and removed, with prune)
+    os.makedirs(dataset_dir, exist_ok=True)
+    ingest_log = load_ingest_log(dataset_dir)
+    sources = ingest_log["sources"]
+    dataset_dir = os.path.abspath(dataset_dir)
+    trace_files = [
+        _file
+        for _file in find_trace_files(paths)
+        if not _file.startswith(dataset_dir + os.path.sep)
+    ]
+
+    ingested = []
+    new_schemas = []
+    for _file in trace_files:
+        stat = os.stat(_file)
+        entry = sources.get(_file)
+        if (
+            (not force)
+            and (entry is not None)
+            and (entry["size"] == stat.st_size)
+            and (entry["mtime_ns"] == stat.st_mtime_ns)
+        ):
+            continue
+
+        try:
+            parts, schemas = _ingest_file(_file, dataset_dir, experiment_type, value_dtype)
+        except Exception as e:
+            print(f"Unable to ingest {_file}: {e}")
+            continue
+        for _part in [] if entry is None else entry["parts"]:
+            if _part not in parts:
+                _remove_part(dataset_dir, _part)
+        sources[_file] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "parts": parts,
+            "ingested": time.time(),
+        }
+        ingested.append(_file)
+        new_schemas += schemas
+        # log after every file so an interrupted run picks up where it stopped
+        save_ingest_log(ingest_log, dataset_dir)
+
+    print(f"Ingested {len(ingested)} of {len(trace_files)} trace files into {dataset_dir}")
+    if prune:
+        removed = [_ for _ in sources if not os.path.exists(_)]
+        for _file in removed:
+            for _part in sources.pop(_file)["parts"]:
+                _remove_part(dataset_dir, _part)
+        save_ingest_log(ingest_log, dataset_dir)
+        if len(removed) > 0:
+            print(f"Removed {len(removed)} trace files that no longer exist")
+        ingested += removed
+
+    if len(new_schemas) > 0:
+        _update_common_metadata(dataset_dir, new_schemas)
+    return ingested
+
+
+def aggregate_dataset(dataset_dir):
+    # pyarrow dataset over the parts in the ingest log. filters on the partition columns
+    # skip whole directories without reading them
+    ingest_log = load_ingest_log(dataset_dir)
+    parts = [
+        os.path.join(dataset_dir, _part)
+        for _entry in ingest_log["sources"].values()
+        for _part in _entry["parts"]
+    ]
+    partitioning = ds.partitioning(
+        pa.schema([(_col, pa.string()) for _col in partition_columns]),
+        flavor="hive",
+    )
+    common_metadata = os.path.join(dataset_dir, common_metadata_name)
+    if os.path.exists(common_metadata):
+        schema = pq.read_schema(common_metadata)
+    else:
+        schema = pa.schema([])
+    for _field in partitioning.schema:
+        if _field.name not in schema.names:
+            schema = schema.append(_field)
+    return ds.dataset(
+        parts,
+        schema=schema,
+        format="parquet",
+        partitioning=partitioning,
+        partition_base_dir=os.path.abspath(dataset_dir),
+    )
+
+
+def read_aggregate(dataset_dir, columns=None, filters=None, categorical=True):
+    # read (part of) the aggregated traces. columns are projected and filters pushed down,
+    # filters are pyarrow expressions or pandas.read_parquet style tuples, e.g.
+    #   read_aggregate(d, columns=["session", "well_sanitized", "roi", "t", "value"],
+    #                  filters=[("session", "in", sessions), ("well_sanitized", "==", "s3-l01-012")])
+    # only the parts of the matching sessions/experiment types/wells are opened
+    if (filters is not None) and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    dataset = aggregate_dataset(dataset_dir)
+    if columns is not None:
+        columns = [_col for _col in columns if _col in dataset.schema.names]
+    traces = dataset.to_table(columns=columns, filter=filters).to_pandas()
+    for _col in traces.columns:
+        if categorical and (_col in partition_columns):
+            traces[_col] = traces[_col].astype("category")
+        elif (not categorical) and isinstance(traces[_col].dtype, pd.CategoricalDtype):
+            traces[_col] = traces[_col].astype(str)
+    return traces
+
+
+def _ingest_file(fname, dataset_dir, experiment_type, value_dtype):
+    metadata = json.loads((pq.read_schema(fname).metadata or {}).get(metadata_key, b"{}"))
+    traces = read_traces(fname, categorical=False)
+    session = source_session(fname)
+    if experiment_type is None:
+        experiment_type = source_experiment_type(fname, metadata)
+    if "well_sanitized" not in traces.columns:
+        traces["well_sanitized"] = None
+
+    source_id = hashlib.sha1(fname.encode()).hexdigest()[:16]
+    parts = []
+    schemas = []
+    for _well, _traces in traces.groupby("well_sanitized", sort=True, dropna=False):
+        _well = None if pd.isna(_well) else _well
+        part = os.path.join(
+            partition_path([session, experiment_type, _well]), f"{source_id}.parquet"
+        )
+        part_fname = os.path.join(dataset_dir, part)
+        os.makedirs(os.path.dirname(part_fname), exist_ok=True)
+        table = _normalize_table(
+            pa.Table.from_pandas(
+                compact_traces(_traces.drop(columns="well_sanitized"), value_dtype=value_dtype),
+                preserve_index=False,
+            )
+        )
+        tmp_fname = f"{part_fname}.tmp"
+        pq.write_table(table, tmp_fname)
+        os.replace(tmp_fname, part_fname)
+        parts.append(part)
+        schemas.append(table.schema)
+    return parts, schemas
+
+
+def _normalize_table(table):
+    # strings as dictionary<int32, string> whatever pandas produced (index width and
+    # string type vary with the number of categories and the pandas version), so the
+    # schemas of all parts can be unified
+    fields = []
+    for _field in table.schema:
+        if pa.types.is_dictionary(_field.type) or pa.types.is_large_string(_field.type):
+            _field = _field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        fields.append(_field)
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+
+def _remove_part(dataset_dir, part):
+    part_fname = os.path.join(dataset_dir, part)
+    if os.path.exists(part_fname):
+        os.remove(part_fname)
+    # drop partition directories left empty
+    part_dir = os.path.dirname(part_fname)
+    while os.path.abspath(part_dir) != os.path.abspath(dataset_dir):
+        try:
+            os.rmdir(part_dir)
+        except OSError:
+            break
+        part_dir = os.path.dirname(part_dir)
+
+
+def _update_common_metadata(dataset_dir, schemas):
+    # union of the schemas of every part ingested so far (files differ in e.g.
+    # value_dff0/value_aux), so readers get all columns without opening every footer
+    fname = os.path.join(dataset_dir, common_metadata_name)
+    if os.path.exists(fname):
+        schemas = [pq.read_schema(fname)] + schemas
+    schema = pa.unify_schemas([_schema.remove_metadata() for _schema in schemas])
+    pq.write_metadata(schema, fname)
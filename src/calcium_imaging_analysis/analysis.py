@@ -1,34 +1,84 @@
 import os
-import joblib
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from skimage.measure import regionprops_table
-from calcium_imaging_analysis.io import short_name, write_video
-from calcium_imaging_analysis.viz import show_segmentation, plot_trace
-
-
+from calcium_imaging_analysis.io import short_name, write_video, load_intermediate
+from calcium_imaging_analysis.viz import (
+    show_segmentation,
+    plot_trace,
+    stack_quantiles,
+    stack_stats,
+)
+from calcium_imaging_analysis.traces import (
+    roi_pixel_index,
+    roi_means,
+    phase_frames,
+    wide_traces,
+    wide_to_long,
+    read_traces,
+    write_traces,
+)
+from calcium_imaging_analysis.baseline import compute_dff0
+from calcium_imaging_analysis.instrument import span, current_span, timing_summary
+from calcium_imaging_analysis.export import (
+    submit_export,
+    save_figures,
+    save_video,
+    export_done,
+    export_in_background,
+)
+from calcium_imaging_analysis.cache import (
+    load_cache,
+    stage_key,
+    cache_lookup,
+    cache_store,
+    cached_array,
+    load_array,
+    save_array,
+)
+
+
+@span("proc_photoswitch")
 def proc_photoswitch(
     proc_fname,
     output_fig_dir=None,
     data_channel=["mCherry"],
     dff0_quantile=0.1,
     force=False,
+    trace_format="wide",  # wide (float32 matrices) or long (melted, categorical strings)
+    baseline="quantile",  # F0 method, quantile, first or rolling_quantile (see baseline.py)
+    baseline_kwargs={},
+    video_kwargs={},  # passed on to write_video, e.g. {"writer": "stream", "preview": {"scale": 4}}
 ):
 
+    # every stage is cached under a key of the intermediate's content and its parameters,
+    # only stages whose inputs changed are recomputed (force recomputes all of them)
     save_fname = os.path.splitext(proc_fname)[0] + ".parquet"
-    if os.path.exists(save_fname) and (not force):
-        traces = pd.read_parquet(save_fname)
-        return traces
+    if baseline == "quantile":
+        baseline_kwargs = {"quantile": dff0_quantile, **baseline_kwargs}
+    cache = load_cache(proc_fname)
+    keys = _stage_keys(
+        cache,
+        data_channel,
+        baseline,
+        baseline_kwargs,
+        save_fname,
+        trace_format,
+        output_fig_dir,
+        video_kwargs,
+    )
+    todo = _stages_todo(cache, keys, force)
+    if not any(todo.values()):
+        return read_traces(save_fname)
 
-    data_dct = joblib.load(proc_fname)
+    data_dct = load_intermediate(proc_fname, channel=data_channel, lazy=True)
 
     if "timesteps" not in data_dct.keys():
         return None
 
     timesteps = data_dct["timesteps"]
-    all_data_reg = data_dct["registered_frames"]
+    signal_data_reg = data_dct["registered_frames"]
     phases = data_dct["phases"]
     phases_first_timestep = data_dct["phases_first_timestep"]
     masks = data_dct["roi_masks"]
@@ -54,109 +104,152 @@ def proc_photoswitch(
     except KeyError:
         experiment_type = "timecourse"
 
-    signal_data_reg = None
-    for _channel in data_channel:
-        try:
-            signal_data_reg = all_data_reg.take(channels.index(_channel), axis=0)
-            break
-        except ValueError:
-            pass
-
-    stats = [
-        regionprops_table(masks, intensity_image=_im, properties=["mean_intensity"])[
-            "mean_intensity"
-        ]
-        for _im in signal_data_reg
-    ]
-
-    df = pd.DataFrame(np.array(stats))
-    df.index.name = "timestep"
-    traces = df
-    traces_name = "Raw Fluo."
-    traces_ratio_name = "Raw Ratio"
-
-    # traces_df0 = traces.rolling(10, 1, True).quantile(.1)
-    # traces_df0 = traces.iloc[:20].median()
-    # traces = (traces - traces_df0) / traces_df0
-    # traces *= 1e2
-    traces["t"] = timesteps
-    traces["frame_number"] = np.arange(len(traces))
-    traces["phase"] = "n/a"
-    for k, v in phases.items():
-        traces.loc[traces.index.isin(v), "phase"] = k
-    if len(phases) > 0:
-        traces = traces.loc[traces["phase"] != "n/a"]
-        traces["t_align"] = traces.groupby("phase")["t"].transform(
-            lambda x: x - phases_first_timestep[x.name]
+    roi_index = roi_pixel_index(masks)
+    # ROI means, clims and the max projection come from one pass over the stack
+    with span("roi_means"):
+        stats, clims, max_proj = _stack_stages(
+            cache, keys, signal_data_reg, roi_index, todo["figures"] or todo["video"], force
         )
-        # traces = traces.melt(var_name="roi", id_vars=["t","phase","t_align"], ignore_index=False).reset_index()
-    else:
-        traces["t_align"] = traces["t"] - traces["t"].iat[0]
 
-    traces = traces.melt(
-        id_vars=["phase", "t", "t_align", "frame_number"], var_name="roi"
-    )
-    traces["well"] = well_name
-    traces["well_sanitized"] = traces["well"].apply(short_name)
-    traces["filename"] = proc_fname
-    traces["value_dff0"] = traces.groupby(["well", "roi"])["value"].transform(
-        lambda x: (x - x.quantile(dff0_quantile)) / x.quantile(dff0_quantile)
-    )
+    frames = phase_frames(timesteps, phases, phases_first_timestep)
+    values = stats[frames["frame_number"].to_numpy()]
+
+    # baseline on the (T, ROI) matrix
+    with span("dff0", method=baseline):
+        dff0 = cached_array(
+            cache,
+            "dff0",
+            keys["dff0"],
+            lambda: compute_dff0(values, method=baseline, **baseline_kwargs),
+            force,
+        )
 
+    rois = {}
     if aux_image is not None:
-        stats_aux = regionprops_table(masks, intensity_image=aux_image, properties=["mean_intensity"])
-        stats_aux = stats_aux["mean_intensity"]
-        stats_aux = {i: val for i, val in enumerate(stats_aux)}
-        traces["value_aux"] = traces["roi"].map(stats_aux)
-    else:
-        stats_aux = {}
-
-    traces.to_parquet(save_fname)
-
-    if output_fig_dir is not None:
-        clims = np.quantile(signal_data_reg, [0.025, 0.995])
-        fig, ax = show_segmentation(np.max(signal_data_reg, axis=0), masks, clims=clims, fluo_cmap="r")
-        fig.suptitle(fname)
-        fig.savefig(f"{sanitized_filename}-max_proj.png", dpi=300, bbox_inches="tight")
-        
+        rois["value_aux"] = roi_means(aux_image[None], roi_index)[0]
+
+    # the wide layout is written from the (T, ROI) matrices, only the compact long table
+    # returned (and plotted) is built
+    wide = wide_traces(
+        frames,
+        {"value": values, "value_dff0": dff0},
+        attrs={
+            "well": well_name,
+            "well_sanitized": short_name(well_name),
+            "filename": proc_fname,
+        },
+        rois=rois,
+    )
+    with span("build_traces"):
+        traces = wide_to_long(wide)
+
+    if todo["output"]:
+        write_traces(
+            wide,
+            save_fname,
+            layout=trace_format,
+            metadata={
+                "timing": timing_summary(current_span()),
+                "experiment_type": experiment_type,
+            },
+        )
+        cache_store(cache, "output", keys["output"], [os.path.abspath(save_fname)])
+
+    # rendering goes through the export queue (see export.py), in the background if
+    # start_exports was called
+    if todo["figures"]:
+        figures = [
+            (
+                f"{sanitized_filename}-max_proj.png",
+                show_segmentation,
+                (max_proj, masks),
+                {"clims": clims, "fluo_cmap": "r", "title": fname},
+            )
+        ]
         if aux_image is not None:
-            aux_clims = np.quantile(aux_image, [0.025, 0.995])
-            fig, ax = show_segmentation(aux_image, masks, clims=aux_clims, fluo_cmap="g")
-            fig.suptitle(fname)
-            fig.savefig(f"{sanitized_filename}-aux_image.png", dpi=300, bbox_inches="tight")
-        
-        fig, ax = plot_trace(traces, phases=phases, x="t", exclude_first_points=False)
-        fig.suptitle(fname)
-        fig.savefig(
-            f"{sanitized_filename}-timecourse-raw.png", dpi=300, bbox_inches="tight"
+            figures.append(
+                (
+                    f"{sanitized_filename}-aux_image.png",
+                    show_segmentation,
+                    (aux_image, masks),
+                    {"clims": stack_quantiles(aux_image[None]), "fluo_cmap": "g", "title": fname},
+                )
+            )
+        figures.append(
+            (
+                f"{sanitized_filename}-timecourse-raw.png",
+                plot_trace,
+                (traces,),
+                {
+                    "phases": phases,
+                    "x": "t",
+                    "exclude_first_points": False,
+                    "summary": True,
+                    "title": fname,
+                },
+            )
         )
-        fig, ax = plot_trace(traces, y="value_dff0", ylabel="dF/F0", phases=phases, x="t", exclude_first_points=False)
-        fig.suptitle(fname)
-        fig.savefig(
-            f"{sanitized_filename}-timecourse-dff0.png", dpi=300, bbox_inches="tight"
+        figures.append(
+            (
+                f"{sanitized_filename}-timecourse-dff0.png",
+                plot_trace,
+                (traces,),
+                {
+                    "y": "value_dff0",
+                    "ylabel": "dF/F0",
+                    "phases": phases,
+                    "x": "t",
+                    "exclude_first_points": False,
+                    "summary": True,
+                    "title": fname,
+                },
+            )
+        )
+        submit_export(
+            save_figures, figures, on_done=export_done(cache, "figures", keys["figures"])
         )
 
+    if todo["video"]:
         # for now pin to 10, but let's change to get accurate timestamps from file directly...
-        write_video(
-            signal_data_reg,
+        submit_export(
+            save_video,
             f"{sanitized_filename}-clims-{clims}.mp4",
+            **_video_source(signal_data_reg, proc_fname, data_channel),
             phases=phases,
-            movie_fps=10,
-            clims=clims,
-            threads=1,
+            **{"movie_fps": 10, "clims": clims, "threads": 1, **video_kwargs},
+            on_done=export_done(cache, "video", keys["video"]),
         )
 
     return traces
 
 
+@span("proc_photobleach")
 def proc_photobleach(
-    proc_fname, output_fig_dir=None, force=False, data_channel=["TRITC"]
+    proc_fname,
+    output_fig_dir=None,
+    force=False,
+    data_channel=["TRITC"],
+    trace_format="wide",
+    baseline=None,  # F0 method to add a value_dff0 column, none by default
+    baseline_kwargs={},
+    video_kwargs={},  # passed on to write_video, e.g. {"writer": "stream", "preview": {"scale": 4}}
 ):
 
     save_fname = os.path.splitext(proc_fname)[0] + ".parquet"
-    if os.path.exists(save_fname) and (not force):
-        traces = pd.read_parquet(save_fname)
-        return traces
+    cache = load_cache(proc_fname)
+    keys = _stage_keys(
+        cache,
+        data_channel,
+        baseline,
+        baseline_kwargs,
+        save_fname,
+        trace_format,
+        output_fig_dir,
+        video_kwargs,
+    )
+    todo = _stages_todo(cache, keys, force)
+    if not any(todo.values()):
+        return read_traces(save_fname)
 
     proc_dir = os.path.dirname(os.path.normpath(proc_fname))
     session_name = proc_dir.split(os.path.sep)[-2]
@@ -169,9 +262,9 @@ def proc_photobleach(
             output_fig_dir, session_name, f"{short_fname}-session-{session_name}"
         )
 
-    data_dct = joblib.load(proc_fname)
+    data_dct = load_intermediate(proc_fname, channel=data_channel, lazy=True)
     timesteps = data_dct["timesteps"]
-    all_data_reg = data_dct["registered_frames"]
+    signal_data_reg = data_dct["registered_frames"]
     phases = data_dct["phases"]
     phases_first_timestep = data_dct["phases_first_timestep"]
     masks = data_dct["roi_masks"]
@@ -183,63 +276,376 @@ def proc_photobleach(
     except KeyError:
         experiment_type = "timecourse"
 
-    signal_data_reg = None
-    for _channel in data_channel:
-        try:
-            signal_data_reg = all_data_reg.take(channels.index(_channel), axis=0)
-            break
-        except ValueError:
-            pass
-
-    stats = [
-        regionprops_table(masks, intensity_image=_im, properties=["mean_intensity"])[
-            "mean_intensity"
-        ]
-        for _im in signal_data_reg
-    ]
-
-    df = pd.DataFrame(np.array(stats))
-    df.index.name = "timestep"
-    traces = df
-    traces_name = "Raw Fluo."
-    traces_ratio_name = "Raw Ratio"
-
-    # traces_df0 = traces.rolling(10, 1, True).quantile(.1)
-    # traces = (traces - traces_df0) / traces_df0
-    # only normalize post-hoc...
-    # traces = traces / traces.iloc[0]
-    traces["t"] = timesteps - timesteps[0]
-    traces["frame_number"] = np.arange(len(traces))
-    traces["phase"] = "n/a"
-    for k, v in phases.items():
-        traces.loc[traces.index.isin(v), "phase"] = k
-    if len(phases) > 0:
-        traces = traces.loc[traces["phase"] != "n/a"]
-        traces["t_align"] = traces.groupby("phase")["t"].transform(
-            lambda x: x - phases_first_timestep[x.name]
+    roi_index = roi_pixel_index(masks)
+    # ROI means, clims and the max projection come from one pass over the stack
+    with span("roi_means"):
+        stats, clims, max_proj = _stack_stages(
+            cache, keys, signal_data_reg, roi_index, todo["figures"] or todo["video"], force
         )
-        # traces = traces.melt(var_name="roi", id_vars=["t","phase","t_align"], ignore_index=False).reset_index()
-    else:
-        traces["t_align"] = traces["t"] - traces["t"].iat[0]
 
-    traces = traces.melt(
-        id_vars=["phase", "t", "t_align", "frame_number"], var_name="roi"
+    frames = phase_frames(timesteps - timesteps[0], phases, phases_first_timestep)
+    values = stats[frames["frame_number"].to_numpy()]
+
+    if baseline is not None:
+        with span("dff0", method=baseline):
+            dff0 = cached_array(
+                cache,
+                "dff0",
+                keys["dff0"],
+                lambda: compute_dff0(values, method=baseline, **baseline_kwargs),
+                force,
+            )
+
+    wide = wide_traces(
+        frames,
+        {"value": values} if baseline is None else {"value": values, "value_dff0": dff0},
+        attrs={
+            "well": well_name,
+            "well_sanitized": short_name(well_name),
+            "filename": proc_fname,
+        },
     )
-    traces["well"] = well_name
-    traces["well_sanitized"] = traces["well"].apply(short_name)
-    traces["filename"] = proc_fname
-    traces.to_parquet(save_fname)
+    with span("build_traces"):
+        traces = wide_to_long(wide)
+    if todo["output"]:
+        write_traces(
+            wide,
+            save_fname,
+            layout=trace_format,
+            metadata={
+                "timing": timing_summary(current_span()),
+                "experiment_type": experiment_type,
+            },
+        )
+        cache_store(cache, "output", keys["output"], [os.path.abspath(save_fname)])
+
+    if todo["figures"]:
+        figures = [
+            (
+                f"{sanitized_filename}-max_proj.png",
+                show_segmentation,
+                (max_proj, masks),
+                {"clims": clims, "title": fname},
+            ),
+            (
+                f"{sanitized_filename}-timecourse.png",
+                plot_trace,
+                (traces,),
+                {"summary": True, "title": fname},
+            ),
+        ]
+        submit_export(
+            save_figures, figures, on_done=export_done(cache, "figures", keys["figures"])
+        )
 
-    if output_fig_dir is not None:
-        clims = np.quantile(signal_data_reg, [0.025, 0.995])
-        fig, ax = show_segmentation(np.max(signal_data_reg, axis=0), masks, clims=clims)
-        fig.suptitle(fname)
-        fig.savefig(f"{sanitized_filename}-max_proj.png", dpi=300, bbox_inches="tight")
-        fig, ax = plot_trace(traces)
-        fig.suptitle(fname)
-        fig.savefig(
-            f"{sanitized_filename}-timecourse.png", dpi=300, bbox_inches="tight"
+    if todo["video"]:
+        submit_export(
+            save_video,
+            f"{sanitized_filename}.mp4",
+            **_video_source(signal_data_reg, proc_fname, data_channel),
+            **{"clims": clims, **video_kwargs},
+            on_done=export_done(cache, "video", keys["video"]),
         )
-        write_video(signal_data_reg, f"{sanitized_filename}.mp4", clims=clims)
 
     return traces
+
+
+# ROI quality control over (aggregated) traces or per-ROI summaries. rows are turned into
+# integer codes once and every statistic is a bincount or one lexsort over those codes,
+# no per-group python callbacks
+qc_reasons = ["min_rois", "low_snr", "mad_outlier"]
+
+
+def roi_summary(traces, by=["session", "well_sanitized", "filename"], value="value", baseline_phase=None):
+    # one row per ROI (by columns present in traces + roi): the mean of value in every
+    # phase (raw_<phase>), the mean and SD in the baseline phase (raw_baseline,
+    # raw_baseline_sd), the percent change of every other phase over baseline
+    # (raw_percent_<phase>_over_baseline) and the aux image mean if there is one.
+    # baseline_phase defaults to the first phase. wide traces (read_traces(layout="wide"))
+    # are reduced on their (T, ROI) matrix, long (e.g. aggregated) traces row by row
+    if isinstance(traces, dict):
+        rois, phases, first_frame, counts, sums, sumsq, aux = _wide_phase_sums(traces, by, value)
+    else:
+        rois, phases, first_frame, counts, sums, sumsq, aux = _long_phase_sums(traces, by, value)
+    nphases = len(phases)
+
+    # phases in the order they start
+    phase_order = np.argsort(first_frame, kind="stable")
+    if baseline_phase is None:
+        baseline_phase = phases[phase_order[0]] if nphases > 0 else None
+    elif baseline_phase not in phases:
+        raise ValueError(f"baseline phase {baseline_phase} not in {list(phases)}")
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        sds = np.sqrt(((sumsq - sums * means) / (counts - 1)).clip(0, None))
+
+    summary = {}
+    for i in phase_order:
+        summary[f"raw_{phases[i]}"] = means[:, i]
+    if baseline_phase is not None:
+        i = int(np.flatnonzero(phases == baseline_phase)[0])
+        summary["raw_baseline"] = means[:, i]
+        summary["raw_baseline_sd"] = sds[:, i]
+        for j in phase_order:
+            if j != i:
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    summary[f"raw_percent_{phases[j]}_over_baseline"] = (
+                        100 * (means[:, j] - means[:, i]) / means[:, i]
+                    )
+    if aux is not None:
+        summary["aux"] = aux
+    return pd.concat([rois, pd.DataFrame(summary)], axis=1)
+
+
+def pivot_summary(summary, index=["session", "well_sanitized", "roi"], columns="value", values="response"):
+    # long per-ROI summaries (one row per ROI and statistic, like the aggregated screen
+    # data) to one row per ROI and one column per statistic
+    row_codes, rows = _row_codes(summary, index)
+    stat_codes, stats = pd.factorize(summary[columns], sort=True)
+    table = np.full((len(rows), len(stats)), np.nan)
+    table[row_codes, stat_codes] = summary[values].to_numpy(dtype="float64")
+    return pd.concat([rows, pd.DataFrame(table, columns=list(stats))], axis=1)
+
+
+def qc_rois(
+    summary,
+    group=["session", "well_sanitized"],
+    mad_column=None,  # default is the first raw_percent_*_over_baseline column
+    nmads=6,
+    mad_scaling=1.4825796886582654,  # MAD to SD of a normal distribution
+    snr_signal="raw_baseline",
+    snr_noise="background_smean_tmean",  # SNR is skipped if summary has no such column
+    snr_threshold=1.25,
+    min_rois=10,
+    count_by=None,  # columns to count ROIs over, default group
+):
+    # keep/reject flags for every ROI of a per-ROI summary (roi_summary or pivot_summary):
+    #   min_rois     fewer than min_rois ROIs in its count_by group
+    #   low_snr      group mean of snr_signal over group mean of snr_noise <= snr_threshold
+    #   mad_outlier  mad_column further than nmads scaled MADs from its group's median
+    # returns summary with n_rois, snr, mad_score, qc_flags (bit i set for qc_reasons[i]),
+    # reason (failed checks joined by ";") and keep. merge keep back on group + roi to
+    # filter traces
+    group = [_col for _col in group if _col in summary.columns]
+    count_by = group if count_by is None else count_by
+    if mad_column is None:
+        mad_columns = [
+            _col
+            for _col in summary.columns
+            if _col.startswith("raw_percent_") and _col.endswith("_over_baseline")
+        ]
+        mad_column = mad_columns[0] if len(mad_columns) > 0 else None
+
+    codes, groups = _row_codes(summary, group)
+    ngroups = len(groups)
+    flags = np.zeros(len(summary), dtype="int64")
+    qc = summary.copy()
+
+    count_codes, count_groups = _row_codes(summary, count_by)
+    qc["n_rois"] = np.bincount(count_codes, minlength=len(count_groups))[count_codes]
+    flags |= (qc["n_rois"].to_numpy() < min_rois).astype("int64") << qc_reasons.index("min_rois")
+
+    missing = [_col for _col in (snr_signal, snr_noise) if _col not in summary.columns]
+    if len(missing) == 0:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            snr = _group_mean(summary[snr_signal].to_numpy(dtype="float64"), codes, ngroups) / _group_mean(
+                summary[snr_noise].to_numpy(dtype="float64"), codes, ngroups
+            )
+        qc["snr"] = snr[codes]
+        flags |= (~(qc["snr"].to_numpy() > snr_threshold)).astype("int64") << qc_reasons.index("low_snr")
+    else:
+        print(f"No {' or '.join(missing)} column in summary, skipping the SNR check")
+        qc["snr"] = np.nan
+
+    if mad_column is not None:
+        x = summary[mad_column].to_numpy(dtype="float64")
+        dev = np.abs(x - _group_median(x, codes, ngroups)[codes])
+        mad = _group_median(dev, codes, ngroups)[codes] * mad_scaling
+        with np.errstate(invalid="ignore", divide="ignore"):
+            qc["mad_score"] = dev / mad
+        flags |= (dev > mad * nmads).astype("int64") << qc_reasons.index("mad_outlier")
+    else:
+        print("No column to find MAD outliers in, skipping the MAD check")
+        qc["mad_score"] = np.nan
+
+    reasons = np.array(
+        [
+            ";".join(_reason for i, _reason in enumerate(qc_reasons) if _flags & (1 << i))
+            for _flags in range(2 ** len(qc_reasons))
+        ],
+        dtype=object,
+    )
+    qc["qc_flags"] = flags
+    qc["reason"] = reasons[flags]
+    qc["keep"] = flags == 0
+    return qc
+
+
+def _long_phase_sums(traces, by, value):
+    # per ROI and phase count, sum and sum of squares of the finite values of long traces,
+    # bincounts over roi * nphases + phase codes
+    by = [_col for _col in by if _col in traces.columns] + ["roi"]
+    roi_codes, rois = _row_codes(traces, by)
+    phase_codes, phases = pd.factorize(traces["phase"], sort=True)
+    phases = np.asarray(phases, dtype=object)
+    nrois, nphases = len(rois), len(phases)
+
+    first_frame = np.full(nphases, np.inf)
+    np.minimum.at(first_frame, phase_codes, traces["frame_number"].to_numpy(dtype="float64"))
+
+    x = traces[value].to_numpy(dtype="float64")
+    valid = np.isfinite(x)
+    idx = (roi_codes * nphases + phase_codes)[valid]
+    x = x[valid]
+    counts = np.bincount(idx, minlength=nrois * nphases).reshape(nrois, nphases)
+    sums = np.bincount(idx, weights=x, minlength=nrois * nphases).reshape(nrois, nphases)
+    sumsq = np.bincount(idx, weights=x**2, minlength=nrois * nphases).reshape(nrois, nphases)
+
+    aux = None
+    if "value_aux" in traces.columns:
+        aux = traces["value_aux"].to_numpy(dtype="float64")
+        aux_valid = np.isfinite(aux)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            aux = np.bincount(
+                roi_codes[aux_valid], weights=aux[aux_valid], minlength=nrois
+            ) / np.bincount(roi_codes[aux_valid], minlength=nrois)
+    return rois, phases, first_frame, counts, sums, sumsq, aux
+
+
+def _wide_phase_sums(wide, by, value):
+    # same as _long_phase_sums on the (T, ROI) matrix of wide traces: frames are grouped
+    # by phase and every phase reduced with one np.add.reduceat over the frame axis
+    rois = pd.DataFrame(
+        {_col: wide["attrs"][_col] for _col in by if _col in wide["attrs"]},
+        index=range(len(wide["rois"])),
+    )
+    rois["roi"] = wide["rois"]["roi"].to_numpy()
+    phase_codes, phases = pd.factorize(wide["frames"]["phase"], sort=True)
+    phases = np.asarray(phases, dtype=object)
+    nphases = len(phases)
+
+    first_frame = np.full(nphases, np.inf)
+    np.minimum.at(
+        first_frame, phase_codes, wide["frames"]["frame_number"].to_numpy(dtype="float64")
+    )
+
+    x = np.asarray(wide["values"][value], dtype="float64")
+    order = np.argsort(phase_codes, kind="stable")
+    starts = np.searchsorted(phase_codes[order], np.arange(nphases))
+    x = x[order]
+    valid = np.isfinite(x)
+    x = np.where(valid, x, 0)
+    if nphases > 0:
+        counts = np.add.reduceat(valid.astype("int64"), starts, axis=0).T
+        sums = np.add.reduceat(x, starts, axis=0).T
+        sumsq = np.add.reduceat(x**2, starts, axis=0).T
+    else:
+        counts = sums = sumsq = np.zeros((len(rois), 0))
+
+    aux = None
+    if "value_aux" in wide["rois"].columns:
+        aux = wide["rois"]["value_aux"].to_numpy(dtype="float64")
+    return rois, phases, first_frame, counts, sums, sumsq, aux
+
+
+def _row_codes(df, columns):
+    # integer code of every row's combination of columns (sorted like a groupby) and the
+    # table of unique combinations
+    codes = np.zeros(len(df), dtype="int64")
+    for _col in columns:
+        _codes, _uniques = pd.factorize(df[_col], sort=True)
+        # hashed, only the unique combinations get sorted
+        codes, _ = pd.factorize(codes * (len(_uniques) + 1) + _codes + 1, sort=True)
+    first = np.zeros(codes.max() + 1 if len(codes) > 0 else 0, dtype="int64")
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    return codes, df[list(columns)].iloc[first].reset_index(drop=True)
+
+
+def _group_mean(x, codes, ngroups):
+    valid = np.isfinite(x)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.bincount(codes[valid], weights=x[valid], minlength=ngroups) / np.bincount(
+            codes[valid], minlength=ngroups
+        )
+
+
+def _group_median(x, codes, ngroups):
+    # median of x within every group ignoring NaN, from one lexsort (NaN sorts last)
+    if len(x) == 0:
+        return np.full(ngroups, np.nan)
+    order = np.lexsort((x, codes))
+    counts = np.bincount(codes, minlength=ngroups)
+    nvalid = np.bincount(codes[~np.isnan(x)], minlength=ngroups)
+    starts = np.cumsum(counts) - counts
+    sorted_x = x[order]
+    lower = sorted_x[(starts + (nvalid - 1) // 2).clip(0, len(x) - 1)]
+    upper = sorted_x[(starts + nvalid // 2).clip(0, len(x) - 1)]
+    return np.where(nvalid > 0, (lower + upper) / 2, np.nan)
+
+
+def _stack_stages(cache, keys, dat, roi_index, projections, force):
+    # (T, ROI) means and, if projections, the clims and max projection of a registered
+    # stack. whatever isn't cached is computed in a single pass, so lazy stacks (registered
+    # views warping the raw file) are read and warped once
+    stats = None if force else load_array(cache, "traces", keys["traces"])
+    clims, max_proj = None, None
+    if projections and not force:
+        clims = load_array(cache, "clims", keys["traces"])
+        max_proj = load_array(cache, "max_proj", keys["traces"])
+    projections = projections and ((clims is None) or (max_proj is None))
+
+    if projections:
+        means = None
+        if stats is None:
+            means = np.empty((len(dat), len(roi_index["labels"])), dtype="float64")
+
+        def _roi_means(start, chunk):
+            if means is not None:
+                means[start : start + len(chunk)] = roi_means(chunk, roi_index)
+
+        clims, max_proj = stack_stats(dat, on_chunk=_roi_means)
+        save_array(cache, "clims", keys["traces"], clims)
+        save_array(cache, "max_proj", keys["traces"], max_proj)
+        if means is not None:
+            stats = save_array(cache, "traces", keys["traces"], means)
+    elif stats is None:
+        stats = save_array(cache, "traces", keys["traces"], roi_means(dat, roi_index))
+    return stats, clims, max_proj
+
+
+def _video_source(signal_data_reg, proc_fname, data_channel):
+    # background workers re-open the intermediate rather than receive the stack
+    if export_in_background():
+        return {"proc_fname": proc_fname, "data_channel": data_channel}
+    return {"dat": signal_data_reg}
+
+
+def _stage_keys(
+    cache,
+    data_channel,
+    baseline,
+    baseline_kwargs,
+    save_fname,
+    trace_format,
+    output_fig_dir,
+    video_kwargs={},
+):
+    # each key chains the keys of the stages it is computed from
+    keys = {"traces": stage_key(cache, "traces", data_channel)}
+    keys["dff0"] = stage_key(cache, "dff0", keys["traces"], baseline, baseline_kwargs)
+    keys["output"] = stage_key(
+        cache, "output", keys["dff0"], os.path.abspath(save_fname), trace_format
+    )
+    if output_fig_dir is not None:
+        output_fig_dir = os.path.abspath(output_fig_dir)
+        keys["figures"] = stage_key(cache, "figures", keys["dff0"], output_fig_dir)
+        keys["video"] = stage_key(cache, "video", keys["traces"], output_fig_dir, video_kwargs)
+    return keys
+
+
+def _stages_todo(cache, keys, force=False):
+    return {
+        _stage: (_stage in keys) and (force or (cache_lookup(cache, _stage, keys[_stage]) is None))
+        for _stage in ("output", "figures", "video")
+    }
@@ -0,0 +1,171 @@
+import numpy as np
+
+# F0 estimators for (T, ROI) trace matrices, all work column-wise on the whole matrix
+
+
+def f0_quantile(values, quantile=0.1):
+    # static quantile of each ROI over the whole recording
+    return np.nanquantile(values, quantile, axis=0, keepdims=True)
+
+
+def f0_first(values, nframes=20):
+    # median of the first nframes of each ROI
+    return np.nanmedian(values[:nframes], axis=0, keepdims=True)
+
+
+def f0_rolling_quantile(values, window=10, quantile=0.1, min_periods=1, center=True):
+    # sliding-window quantile of each ROI, same result as
+    # DataFrame.rolling(window, min_periods, center).quantile(quantile).
+    # keeps every ROI's window sorted and updates it with one removal and one insertion
+    # per frame, so each step is O(window * ROI) in numpy regardless of recording length
+    values = np.asarray(values, dtype="float64")
+    nframes, nrois = values.shape
+    if window == 1:
+        return values.copy() if min_periods <= 1 else np.full_like(values, np.nan)
+    if center:
+        after = (window - 1) // 2
+    else:
+        after = 0
+    before = window - 1 - after
+
+    # pad so every output frame has a full window, padding is NaN and never counts
+    padded = np.concatenate(
+        [np.full((before, nrois), np.nan), values, np.full((after, nrois), np.nan)]
+    ).T
+    sorted_window = np.sort(padded[:, :window], axis=1)  # NaNs sort last
+
+    f0 = np.empty((nframes, nrois))
+    for i in range(nframes):
+        if i > 0:
+            sorted_window = _window_replace(
+                sorted_window, padded[:, i - 1], padded[:, i + window - 1]
+            )
+        f0[i] = _window_quantile(sorted_window, quantile, min_periods)
+    return f0
+
+
+baseline_methods = {
+    "quantile": f0_quantile,
+    "first": f0_first,
+    "rolling_quantile": f0_rolling_quantile,
+}
+
+
+def compute_f0(values, method="quantile", **kwargs):
+    if method not in baseline_methods:
+        raise RuntimeError(f"Baseline method {method} not recognized")
+    return baseline_methods[method](values, **kwargs)
+
+
+def compute_dff0(values, method="quantile", **kwargs):
+    # (F - F0) / F0 on a (T, ROI) matrix
+    f0 = compute_f0(values, method=method, **kwargs)
+    return (values - f0) / f0
+
+
+# streaming F0 for live acquisitions: update(row) takes the (ROI,) values of the next frame
+# and returns that frame's F0, at O(1) cost in the number of frames seen. revised is the
+# number of frames before the last one whose F0 changed to the F0 just returned (their
+# dF/F0 needs recomputing)
+class FirstF0:
+    # f0_first over the frames so far, fixed once nframes frames have been seen
+    def __init__(self, nrois, nframes=20):
+        self.first = np.full((nframes, nrois), np.nan)
+        self.nseen = 0
+        self.f0 = np.full(nrois, np.nan)
+        self.revised = 0
+
+    def update(self, row):
+        self.revised = 0
+        if self.nseen < len(self.first):
+            self.first[self.nseen] = row
+            self.nseen += 1
+            self.f0 = np.nanmedian(self.first[: self.nseen], axis=0)
+            if self.nseen == len(self.first):
+                self.revised = self.nseen - 1
+        return self.f0
+
+
+class RollingQuantileF0:
+    # f0_rolling_quantile with center=False, the window trails the newest frame
+    def __init__(self, nrois, window=10, quantile=0.1, min_periods=1):
+        self.window = window
+        self.quantile = quantile
+        self.min_periods = min_periods
+        self.sorted_window = np.full((nrois, window), np.nan)
+        self.recent = np.full((window, nrois), np.nan)  # ring buffer of the last frames
+        self.nseen = 0
+        self.revised = 0
+
+    def update(self, row):
+        row = np.asarray(row, dtype="float64")
+        if self.window == 1:
+            return row.copy() if self.min_periods <= 1 else np.full_like(row, np.nan)
+        slot = self.nseen % self.window
+        self.sorted_window = _window_replace(self.sorted_window, self.recent[slot], row)
+        self.recent[slot] = row
+        self.nseen += 1
+        return _window_quantile(self.sorted_window, self.quantile, self.min_periods)
+
+
+streaming_baseline_methods = {
+    "first": FirstF0,
+    "rolling_quantile": RollingQuantileF0,
+}
+
+
+def streaming_f0(nrois, method="first", **kwargs):
+    if method not in streaming_baseline_methods:
+        raise RuntimeError(
+            f"Baseline method {method} can't be computed frame by frame, "
+            f"use one of {list(streaming_baseline_methods)}"
+        )
+    return streaming_baseline_methods[method](nrois, **kwargs)
+
+
+def _window_replace(sorted_window, outgoing, incoming):
+    # remove one value from every row of a sorted (ROI, window) array and insert another,
+    # keeping the rows sorted with NaNs last
+    nrois, window = sorted_window.shape
+    positions = np.arange(window)
+    rows = np.arange(nrois)
+
+    # remove the outgoing value (first match, or first NaN)
+    outgoing_nan = np.isnan(outgoing)
+    matches = np.where(
+        outgoing_nan[:, None], np.isnan(sorted_window), sorted_window == outgoing[:, None]
+    )
+    keep = np.ones_like(matches)
+    keep[rows, np.argmax(matches, axis=1)] = False
+    remaining = sorted_window[keep].reshape(nrois, window - 1)
+
+    # insert the incoming value after everything smaller than it, NaNs go last
+    insert_at = np.where(
+        np.isnan(incoming),
+        window - 1,
+        (remaining < incoming[:, None]).sum(axis=1),
+    )[:, None]
+    shifted = np.concatenate([remaining, remaining[:, -1:]], axis=1)
+    return np.where(
+        positions < insert_at,
+        shifted,
+        np.where(
+            positions == insert_at,
+            incoming[:, None],
+            shifted[:, np.maximum(positions - 1, 0)],
+        ),
+    )
+
+
+def _window_quantile(sorted_window, quantile, min_periods):
+    # linear interpolation between order statistics of the valid values
+    rows = np.arange(len(sorted_window))
+    nvalid = (~np.isnan(sorted_window)).sum(axis=1)
+    rank = quantile * np.maximum(nvalid - 1, 0)
+    lower = np.floor(rank).astype("int")
+    upper = np.ceil(rank).astype("int")
+    lower_value = sorted_window[rows, lower]
+    upper_value = sorted_window[rows, upper]
+    f0 = lower_value + (upper_value - lower_value) * (rank - lower)
+    f0[nvalid < max(min_periods, 1)] = np.nan
+    return f0
@@ -0,0 +1,312 @@
+import os
+import json
+import glob
+import time
+import argparse
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm.auto import tqdm
+from calcium_imaging_analysis.io import nd2_metadata_parse, find_intermediate, parse_size
+from calcium_imaging_analysis.cache import evict_stale, cache_dir_name
+
+manifest_name = "_analysis_manifest.json"
+
+# bytes per element on top of the registered frames: the raw roi channel and one raw channel
+registration_overhead = 2 + 2
+
+
+def find_nd2_files(paths):
+    # accepts directories (searched recursively), globs or files
+    if isinstance(paths, str):
+        paths = [paths]
+    nd2_files = []
+    for _path in paths:
+        if os.path.isdir(_path):
+            nd2_files += glob.glob(os.path.join(_path, "**", "*.nd2"), recursive=True)
+        else:
+            nd2_files += glob.glob(_path, recursive=True)
+    return sorted(set(os.path.normpath(_file) for _file in nd2_files))
+
+
+def build_manifest(paths, wells_per_job=8, output_dtype="float64"):
+    # one job per chunk of wells (or per file for single-well files), each job
+    # records the intermediate .h5 and final .parquet files it is responsible for
+    jobs = []
+    for _file in find_nd2_files(paths):
+        try:
+            metadata = nd2_metadata_parse(_file)
+        except Exception as e:
+            print(f"Unable to parse {_file}: {e}")
+            continue
+
+        output_dir = os.path.join(os.path.dirname(_file), "_analysis")
+        dim_sizes = dict(metadata["dim_sizes"])
+        well_bytes = (
+            int(np.prod([_size for _dim, _size in dim_sizes.items() if _dim != "P"]))
+            * (np.dtype(output_dtype).itemsize + registration_overhead)
+        )
+        if len(metadata["wells"]) > 0:
+            well_chunks = [
+                metadata["wells"][i : i + wells_per_job]
+                for i in range(0, len(metadata["wells"]), wells_per_job)
+            ]
+        else:
+            well_chunks = [None]
+
+        for _wells in well_chunks:
+            if _wells is None:
+                names = [os.path.splitext(os.path.basename(_file))[0]]
+            else:
+                names = _wells
+            proc_files = [os.path.join(output_dir, f"{_name}.h5") for _name in names]
+            jobs.append(
+                {
+                    "id": f"{_file}::{','.join(names)}",
+                    "nd2": _file,
+                    "wells": _wells,
+                    "proc_files": proc_files,
+                    "parquet_files": [
+                        os.path.splitext(_proc)[0] + ".parquet" for _proc in proc_files
+                    ],
+                    "memory_estimate": well_bytes,
+                    "status": "pending",
+                }
+            )
+    return {"jobs": jobs}
+
+
+def load_manifest(manifest_fname):
+    with open(manifest_fname, "r") as f:
+        manifest = json.load(f)
+    # anything still marked as running was interrupted, start it over
+    for _job in manifest["jobs"]:
+        if _job["status"] == "running":
+            _job["status"] = "pending"
+    return manifest
+
+
+def save_manifest(manifest, manifest_fname):
+    # write to a temporary file first so a killed run never leaves a truncated manifest
+    tmp_fname = f"{manifest_fname}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_fname, manifest_fname)
+
+
+def run_job(
+    job,
+    experiment_type="photoswitch",
+    proc="photoswitch",
+    register_kwargs={},
+    proc_kwargs={},
+    export_workers=0,
+    timing_log=None,
+):
+    from calcium_imaging_analysis.registration import register_plate
+    from calcium_imaging_analysis.analysis import proc_photoswitch, proc_photobleach
+    from calcium_imaging_analysis.export import (
+        start_exports,
+        wait_exports,
+        stop_exports,
+        export_in_background,
+    )
+    from calcium_imaging_analysis.instrument import span, log_spans_to
+
+    if timing_log is not None:
+        log_spans_to(timing_log)
+
+    with span("register_plate", nd2=job["nd2"]):
+        register_plate(
+            job["nd2"],
+            wells=job["wells"],
+            experiment_type=experiment_type,
+            **register_kwargs,
+        )
+
+    if proc == "photoswitch":
+        proc_func = proc_photoswitch
+    elif proc == "photobleach":
+        proc_func = proc_photobleach
+    else:
+        return job["id"]
+
+    # figures and videos of one well render while the next well's traces are extracted
+    started_exports = (export_workers > 0) and (not export_in_background())
+    if started_exports:
+        start_exports(export_workers)
+    try:
+        for _proc in job["proc_files"]:
+            # wells registered by older versions may have a legacy .p file instead
+            use_proc = find_intermediate(os.path.splitext(_proc)[0])
+            if use_proc is not None:
+                proc_func(use_proc, **proc_kwargs)
+    finally:
+        # a pool started here is shut down, its processes would keep the worker from exiting
+        nfailed = stop_exports() if started_exports else wait_exports()
+    if nfailed > 0:
+        raise RuntimeError(f"{nfailed} figure/video exports failed")
+    return job["id"]
+
+
+def run_manifest(
+    manifest,
+    manifest_fname,
+    n_workers=1,
+    memory_budget=None,
+    retry_failed=False,
+    **kwargs,
+):
+    todo = [
+        _job
+        for _job in manifest["jobs"]
+        if (_job["status"] == "pending") or (retry_failed and _job["status"] == "failed")
+    ]
+    if len(todo) == 0:
+        print("Nothing to do")
+        return manifest
+
+    # keep the number of concurrent jobs inside the memory budget
+    memory_budget = parse_size(memory_budget)
+    if memory_budget is not None:
+        max_job_memory = max(_job["memory_estimate"] for _job in todo)
+        n_workers = max(1, min(n_workers, memory_budget // max(max_job_memory, 1)))
+    n_workers = int(min(n_workers, len(todo)))
+    print(f"Running {len(todo)} jobs on {n_workers} workers")
+
+    # wells that don't fit in a worker's share of the budget are registered into a memmap
+    if memory_budget is not None:
+        kwargs["register_kwargs"] = {
+            "memory_budget": memory_budget // n_workers,
+            **kwargs.get("register_kwargs", {}),
+        }
+
+    jobs_by_id = {_job["id"]: _job for _job in todo}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for _job in todo:
+            futures[executor.submit(run_job, _job, **kwargs)] = _job["id"]
+            _job["status"] = "running"
+            _job["started"] = time.time()
+        save_manifest(manifest, manifest_fname)
+
+        for _future in tqdm(as_completed(futures), total=len(futures)):
+            _job = jobs_by_id[futures[_future]]
+            try:
+                _future.result()
+                _job["status"] = "done"
+                _job.pop("error", None)
+            except Exception:
+                _job["status"] = "failed"
+                _job["error"] = traceback.format_exc()
+            _job["finished"] = time.time()
+            save_manifest(manifest, manifest_fname)
+
+    # clear cache entries of intermediates that no longer exist
+    for _dir in sorted(set(os.path.dirname(_job["proc_files"][0]) for _job in todo)):
+        evict_stale(os.path.join(_dir, cache_dir_name))
+
+    nfailed = sum(_job["status"] == "failed" for _job in manifest["jobs"])
+    if nfailed > 0:
+        print(f"{nfailed} jobs failed, see {manifest_fname}")
+    return manifest
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Register, segment and extract traces from a directory of ND2 files"
+    )
+    parser.add_argument("paths", nargs="+", help="directories (searched recursively) or globs of ND2 files")
+    parser.add_argument("--experiment-type", default="photoswitch", choices=["photoswitch", "timecourse", "other"])
+    parser.add_argument("--proc", default=None, choices=["photoswitch", "photobleach", "none"], help="trace extraction to run on each intermediate file (default follows --experiment-type)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--memory-budget", default=None, help="total memory for all workers, e.g. 200G")
+    parser.add_argument("--wells-per-job", type=int, default=8)
+    parser.add_argument("--manifest", default=None, help=f"manifest file (default {manifest_name} in the first directory)")
+    parser.add_argument("--rebuild-manifest", action="store_true")
+    parser.add_argument("--retry-failed", action="store_true")
+    parser.add_argument("--data-channel", nargs="+", default=None)
+    parser.add_argument("--roi-channel", nargs="+", default=None)
+    parser.add_argument("--segment-batch-size", type=int, default=1, help="wells segmented per cellpose call")
+    parser.add_argument("--registration-downsample", type=int, default=1, help="estimate transforms at 1/N resolution")
+    parser.add_argument("--registration-threads", type=int, default=1, help="threads used to warp channels")
+    parser.add_argument("--transforms-only", action="store_true", help="store transforms instead of registered frames")
+    parser.add_argument("--registration-dtype", default="float64", help="dtype of registered frames, e.g. float32 or uint16")
+    parser.add_argument("--output-fig-dir", default=None)
+    parser.add_argument("--video-writer", default="preview", choices=["preview", "stream"], help="stream colormaps and encodes videos chunk by chunk with flat memory")
+    parser.add_argument("--video-preview", type=int, nargs=2, default=None, metavar=("SCALE", "STEP"), help="also write a preview video downsampled by SCALE in space and STEP in time (stream writer)")
+    parser.add_argument("--export-workers", type=int, default=0, help="background processes per worker rendering figures and videos")
+    parser.add_argument("--timing-log", default=None, help="append a JSON line per instrumented stage to this file")
+    parser.add_argument("--force", action="store_true", help="recompute trace files that already exist")
+    parser.add_argument("--aggregate", default=None, metavar="DATASET_DIR", help="append the trace files of finished jobs to this partitioned dataset")
+    args = parser.parse_args(args)
+
+    manifest_fname = args.manifest
+    if manifest_fname is None:
+        base_dir = args.paths[0] if os.path.isdir(args.paths[0]) else os.getcwd()
+        manifest_fname = os.path.join(base_dir, manifest_name)
+
+    if os.path.exists(manifest_fname) and (not args.rebuild_manifest):
+        print(f"Resuming from {manifest_fname}")
+        manifest = load_manifest(manifest_fname)
+    else:
+        manifest = build_manifest(
+            args.paths, wells_per_job=args.wells_per_job, output_dtype=args.registration_dtype
+        )
+        save_manifest(manifest, manifest_fname)
+
+    proc = args.proc
+    if proc is None:
+        proc = "photoswitch" if args.experiment_type == "photoswitch" else "photobleach"
+
+    register_kwargs = {
+        "segment_batch_size": args.segment_batch_size,
+        "registration_downsample": args.registration_downsample,
+        "registration_threads": args.registration_threads,
+        "save_registered_frames": not args.transforms_only,
+        "output_dtype": args.registration_dtype,
+    }
+    if args.roi_channel is not None:
+        register_kwargs["roi_channel"] = args.roi_channel
+    proc_kwargs = {"output_fig_dir": args.output_fig_dir, "force": args.force}
+    if args.video_writer != "preview":
+        proc_kwargs["video_kwargs"] = {"writer": args.video_writer}
+        if args.video_preview is not None:
+            proc_kwargs["video_kwargs"]["preview"] = {
+                "scale": args.video_preview[0],
+                "step": args.video_preview[1],
+            }
+    if args.data_channel is not None:
+        proc_kwargs["data_channel"] = args.data_channel
+
+    run_manifest(
+        manifest,
+        manifest_fname,
+        n_workers=args.workers,
+        memory_budget=args.memory_budget,
+        retry_failed=args.retry_failed,
+        experiment_type=args.experiment_type,
+        proc=proc,
+        register_kwargs=register_kwargs,
+        proc_kwargs=proc_kwargs,
+        export_workers=args.export_workers,
+        timing_log=args.timing_log,
+    )
+
+    if args.aggregate is not None:
+        from calcium_imaging_analysis.aggregate import aggregate_traces
+
+        aggregate_traces(
+            [
+                _fname
+                for _job in manifest["jobs"]
+                if _job["status"] == "done"
+                for _fname in _job["parquet_files"]
+                if os.path.exists(_fname)
+            ],
+            args.aggregate,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import numpy as np
+from calcium_imaging_analysis.io import intermediate_extensions
+
+# per-intermediate stage cache for proc_*. every stage (traces, dff0, output, figures, video)
+# is stored under a key that hashes the intermediate file's content together with the
+# parameters of that stage and the keys of the stages it depends on, so changing a
+# parameter only invalidates the stages downstream of it. each intermediate gets its own
+# index file so batch workers never write to the same index
+cache_dir_name = "_cache"
+
+
+def cache_paths(proc_fname):
+    proc_dir = os.path.dirname(os.path.abspath(proc_fname))
+    cache_dir = os.path.join(proc_dir, cache_dir_name)
+    base = os.path.splitext(os.path.basename(proc_fname))[0]
+    return cache_dir, os.path.join(cache_dir, f"{base}.json")
+
+
+def file_hash(fname, block_size=2**22):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for _block in iter(lambda: f.read(block_size), b""):
+            h.update(_block)
+    return h.hexdigest()
+
+
+def params_hash(*params):
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=_to_json).encode()
+    ).hexdigest()
+
+
+def load_cache(proc_fname):
+    # the content hash of the intermediate is only recomputed when its size or mtime change
+    cache_dir, index_fname = cache_paths(proc_fname)
+    try:
+        with open(index_fname, "r") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {"source": {}, "stages": {}}
+
+    stat = os.stat(proc_fname)
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if {k: cache["source"].get(k) for k in source} != source:
+        source["hash"] = file_hash(proc_fname)
+        cache["source"] = source
+    cache["dir"] = cache_dir
+    cache["index"] = index_fname
+    return cache
+
+
+def save_cache(cache):
+    os.makedirs(cache["dir"], exist_ok=True)
+    tmp_fname = f"{cache['index']}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump({"source": cache["source"], "stages": cache["stages"]}, f, indent=1)
+    os.replace(tmp_fname, cache["index"])
+
+
+def stage_key(cache, stage, *params):
+    return params_hash(cache["source"]["hash"], stage, *params)
+
+
+def cache_lookup(cache, stage, key):
+    # outputs of a stage if it was computed with the same key and nothing was deleted since,
+    # otherwise None
+    entry = cache["stages"].get(stage)
+    if (entry is None) or (entry["key"] != key):
+        return None
+    if not all(os.path.exists(_output) for _output in entry["outputs"]):
+        return None
+    return entry["outputs"]
+
+
+def cache_store(cache, stage, key, outputs=[]):
+    # record a stage and evict the arrays the stale entry left in the cache directory.
+    # outputs elsewhere (parquet, figures, videos) are only overwritten, never deleted
+    entry = cache["stages"].get(stage)
+    if entry is not None:
+        for _output in entry["outputs"]:
+            if (
+                (_output not in outputs)
+                and (os.path.dirname(_output) == cache["dir"])
+                and os.path.exists(_output)
+            ):
+                os.remove(_output)
+    cache["stages"][stage] = {"key": key, "outputs": list(outputs)}
+    save_cache(cache)
+
+
+def cache_fname(cache, stage, key, ext=".npy"):
+    base = os.path.splitext(os.path.basename(cache["index"]))[0]
+    return os.path.join(cache["dir"], f"{base}-{stage}-{key[:16]}{ext}")
+
+
+def save_array(cache, stage, key, arr):
+    os.makedirs(cache["dir"], exist_ok=True)
+    fname = cache_fname(cache, stage, key)
+    np.save(fname, arr)
+    cache_store(cache, stage, key, [fname])
+    return arr
+
+
+def load_array(cache, stage, key):
+    outputs = cache_lookup(cache, stage, key)
+    if outputs is None:
+        return None
+    try:
+        return np.load(outputs[0])
+    except (ValueError, OSError):
+        return None
+
+
+def cached_array(cache, stage, key, func, force=False):
+    # load a stage's array, or compute it with func() and store it
+    arr = None if force else load_array(cache, stage, key)
+    if arr is None:
+        arr = save_array(cache, stage, key, func())
+    return arr
+
+
+def evict_stale(cache_dir):
+    # drop indexes whose intermediate is gone and any array not referenced by an index
+    if not os.path.isdir(cache_dir):
+        return []
+    proc_dir = os.path.dirname(cache_dir)
+    referenced = set()
+    removed = []
+    for _index in sorted(os.listdir(cache_dir)):
+        if not _index.endswith(".json"):
+            continue
+        _index_fname = os.path.join(cache_dir, _index)
+        base = os.path.splitext(_index)[0]
+        if any(
+            os.path.exists(os.path.join(proc_dir, f"{base}{_ext}")) for _ext in intermediate_extensions
+        ):
+            with open(_index_fname, "r") as f:
+                stages = json.load(f)["stages"]
+            for _entry in stages.values():
+                referenced.update(os.path.abspath(_output) for _output in _entry["outputs"])
+        else:
+            os.remove(_index_fname)
+            removed.append(_index_fname)
+    for _fname in sorted(os.listdir(cache_dir)):
+        _fname = os.path.abspath(os.path.join(cache_dir, _fname))
+        if _fname.endswith(".npy") and (_fname not in referenced):
+            os.remove(_fname)
+            removed.append(_fname)
+    return removed
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (np.ndarray, range)):
+        return list(value)
+    return str(value)
@@ -0,0 +1,106 @@
+import os
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from calcium_imaging_analysis.instrument import span
+
+# figure and video export off the trace extraction path. jobs go to a pool of worker
+# processes (pyplot isn't thread-safe) and at most max_pending are in flight, submitting
+# beyond that waits for the oldest job. without a pool jobs run in the calling process
+_exports = {"executor": None, "pending": [], "max_pending": 0}
+
+
+def start_exports(n_workers=1, max_pending=None):
+    stop_exports()
+    if n_workers > 0:
+        _exports["executor"] = ProcessPoolExecutor(max_workers=n_workers)
+        _exports["max_pending"] = 2 * n_workers if max_pending is None else max_pending
+
+
+def export_in_background():
+    return _exports["executor"] is not None
+
+
+def submit_export(func, *args, on_done=None, **kwargs):
+    # on_done(result) runs in the calling process once the job finished
+    if _exports["executor"] is None:
+        result = func(*args, **kwargs)
+        if on_done is not None:
+            on_done(result)
+        return
+    while (len(_exports["pending"]) > 0) and (
+        (len(_exports["pending"]) >= _exports["max_pending"]) or _exports["pending"][0][0].done()
+    ):
+        _finish_export(*_exports["pending"].pop(0))
+    _exports["pending"].append(
+        (_exports["executor"].submit(func, *args, **kwargs), on_done)
+    )
+
+
+def wait_exports():
+    # block until every submitted job is done, returns the number of failed jobs
+    nfailed = 0
+    while len(_exports["pending"]) > 0:
+        nfailed += not _finish_export(*_exports["pending"].pop(0))
+    return nfailed
+
+
+def stop_exports():
+    nfailed = wait_exports()
+    if _exports["executor"] is not None:
+        _exports["executor"].shutdown()
+        _exports["executor"] = None
+    return nfailed
+
+
+def _finish_export(future, on_done):
+    try:
+        result = future.result()
+    except Exception as e:
+        print(f"Export failed: {e}")
+        return False
+    if on_done is not None:
+        on_done(result)
+    return True
+
+
+def save_figure(fname, plot_func, *args, title=None, dpi=300, **kwargs):
+    fig, ax = plot_func(*args, **kwargs)
+    try:
+        if title is not None:
+            fig.suptitle(title)
+        fig.savefig(fname, dpi=dpi, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+    return fname
+
+
+@span("save_figures")
+def save_figures(figures):
+    # figures is a list of (fname, plot_func, args, kwargs), rendered in order
+    return [
+        save_figure(_fname, _plot_func, *_args, **_kwargs)
+        for _fname, _plot_func, _args, _kwargs in figures
+    ]
+
+
+@span("save_video")
+def save_video(fname, dat=None, proc_fname=None, data_channel=None, **kwargs):
+    # workers get the intermediate file instead of the stack and read it lazily themselves
+    from calcium_imaging_analysis.io import write_video, load_intermediate
+
+    if dat is None:
+        dat = load_intermediate(proc_fname, channel=data_channel, lazy=True)["registered_frames"]
+    write_video(dat, fname, **kwargs)
+    return fname
+
+
+def export_done(cache, stage, key):
+    # on_done callback recording finished exports in the stage cache
+    from calcium_imaging_analysis.cache import cache_store
+
+    def _store(outputs):
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        cache_store(cache, stage, key, [os.path.abspath(_output) for _output in outputs])
+
+    return _store
@@ -0,0 +1,377 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# exponential decay fits of every ROI at once, e.g. photobleaching curves from
+# proc_photobleach. values are (T, ROI) matrices (NaN where a ROI has no sample) and
+# every ROI is fit by its own Levenberg-Marquardt iteration, batched over ROIs:
+#   monoexp  I(t) = I0 * exp(-t / tau) + C
+#   biexp    I(t) = I0_fast * exp(-t / tau_fast) + I0_slow * exp(-t / tau_slow) + C
+# rates (1 / tau) are fit in units of the time span and amplitudes in units of each
+# ROI's range, so one set of tolerances works for any recording
+fit_models = ["monoexp", "biexp"]
+
+
+def monoexp_decay(t, I0, tau, C=0):
+    return I0 * np.exp(-t / tau) + C
+
+
+def biexp_decay(t, I0_fast, tau_fast, I0_slow, tau_slow, C=0):
+    return I0_fast * np.exp(-t / tau_fast) + I0_slow * np.exp(-t / tau_slow) + C
+
+
+def fit_decays(
+    t,
+    values,
+    model="monoexp",
+    include_offset=True,
+    max_iter=200,
+    tol=1.5e-8,  # relative change of the cost or the parameters, as curve_fit's ftol/xtol
+    chunk_size=None,
+    n_workers=1,
+):
+    # t is (T,) or (T, ROI), values (T, ROI). returns one row per ROI with the fitted
+    # parameters, their standard errors, r_squared, n_iter and success. chunk_size ROIs
+    # are solved together, by default as many as keep each (ROI, T) array around 1 MB
+    # (the iteration is memory bound), chunks go to n_workers processes if n_workers > 1
+    if model not in fit_models:
+        raise ValueError(f"model must be one of {fit_models}, got {model}")
+    values = np.asarray(values, dtype="float64")
+    if values.ndim == 1:
+        values = values[:, None]
+    if values.size == 0:
+        # nothing to fit, every ROI fails
+        fits = pd.DataFrame(
+            np.nan, index=range(values.shape[1]), columns=_result_columns(model, include_offset)
+        )
+        return fits.assign(n_iter=0, success=False)
+    t = np.broadcast_to(np.asarray(t, dtype="float64").reshape(len(values), -1), values.shape)
+    if chunk_size is None:
+        chunk_size = int(np.clip(2**17 // max(len(values), 1), 16, 1024))
+
+    chunks = [
+        (t[:, _start : _start + chunk_size].T, values[:, _start : _start + chunk_size].T)
+        for _start in range(0, values.shape[1], chunk_size)
+    ]
+    fit_kwargs = {
+        "model": model,
+        "include_offset": include_offset,
+        "max_iter": max_iter,
+        "tol": tol,
+    }
+    if (n_workers > 1) and (len(chunks) > 1):
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_fit_chunk, *_chunk, **fit_kwargs) for _chunk in chunks]
+            results = [_future.result() for _future in futures]
+    else:
+        results = [_fit_chunk(*_chunk, **fit_kwargs) for _chunk in chunks]
+
+    return pd.concat([pd.DataFrame(_result) for _result in results], ignore_index=True)
+
+
+def fit_traces(traces, value="value", time="t", by=["filename", "roi"], **kwargs):
+    # fit_decays on a trace table: the long layout (one curve per unique combination of
+    # by, e.g. the aggregated traces of many files) or the wide dict from read_traces.
+    # returns the by columns (the ROI table for wide traces) next to the fit results
+    if isinstance(traces, dict):
+        keys = traces["rois"].copy()
+        for _col, _value in traces["attrs"].items():
+            keys[_col] = _value
+        fits = fit_decays(traces["frames"][time], traces["values"][value], **kwargs)
+        return pd.concat([keys.reset_index(drop=True), fits], axis=1)
+
+    by = [by] if isinstance(by, str) else list(by)
+    traces = traces.sort_values(time, kind="stable")
+    grouped = traces.groupby(by, sort=True, observed=True)
+    curve_idx = grouped.ngroup().to_numpy()
+    sample_idx = grouped.cumcount().to_numpy()
+    keys = grouped.size().index.to_frame(index=False)
+
+    # (T, curve) matrices, curves shorter than the longest one are padded with NaN
+    t = np.full((sample_idx.max() + 1 if len(traces) > 0 else 0, len(keys)), np.nan)
+    values = np.full(t.shape, np.nan)
+    t[sample_idx, curve_idx] = traces[time].to_numpy(dtype="float64")
+    values[sample_idx, curve_idx] = traces[value].to_numpy(dtype="float64")
+    fits = fit_decays(np.where(np.isnan(t), 0, t), values, **kwargs)
+    return pd.concat([keys, fits], axis=1)
+
+
+def _result_columns(model, include_offset):
+    params = _param_names(model, include_offset)
+    columns = params + [f"{_param}_error" for _param in params] + ["r_squared", "n_iter", "success"]
+    if model == "biexp":
+        columns = ["I0", "tau"] + columns
+    return columns
+
+
+def _param_names(model, include_offset):
+    if model == "monoexp":
+        names = ["I0", "tau"]
+    else:
+        names = ["I0_fast", "tau_fast", "I0_slow", "tau_slow"]
+    return names + ["C"] if include_offset else names
+
+
+def _fit_chunk(t, y, model="monoexp", include_offset=True, max_iter=200, tol=1.5e-8):
+    # (N, T) times and values -> dict of (N,) result columns
+    nexp = 1 if model == "monoexp" else 2
+    w = np.isfinite(y) & np.isfinite(t)
+    y = np.where(w, y, 0)
+    t = np.where(w, t, 0)
+    nsamples = w.sum(axis=1)
+
+    # scale to t in [0, 1] and y in [0, 1] per curve
+    t_min = np.where(w, t, np.inf).min(axis=1, keepdims=True)
+    t_min = np.where(np.isfinite(t_min), t_min, 0)
+    t_scale = (np.where(w, t, -np.inf).max(axis=1, keepdims=True) - t_min).clip(1e-12, None)
+    t_scale = np.where(np.isfinite(t_scale), t_scale, 1)
+    y_min = np.where(w, y, np.inf).min(axis=1, keepdims=True)
+    y_max = np.where(w, y, -np.inf).max(axis=1, keepdims=True)
+    y_scale = np.where(np.isfinite(y_max - y_min), y_max - y_min, 1).clip(1e-12, None)
+    ts = np.where(w, (t - t_min) / t_scale, 0)
+    ys = np.where(w, y / y_scale, 0)
+
+    if nexp == 2:
+        # the biexponential starts from the monoexponential fit
+        p, _, _, _ = _levenberg_marquardt(
+            _init_params(ts, ys, w, 1, include_offset), ts, ys, w, 1, include_offset, max_iter, tol
+        )
+        p = _split_params(p, include_offset)
+    else:
+        p = _init_params(ts, ys, w, nexp, include_offset)
+    nparams = p.shape[1]
+    p, cost, n_iter, converged = _levenberg_marquardt(
+        p, ts, ys, w, nexp, include_offset, max_iter, tol
+    )
+
+    # standard errors from the final jacobian, cov = s^2 (J'J)^-1
+    jac = _jacobian(p, ts, _basis(p, ts, w, nexp, include_offset), nexp, include_offset)
+    jtj = np.matmul(jac, jac.transpose(0, 2, 1))
+    dof = (nsamples - nparams).clip(1, None)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = np.linalg.pinv(jtj) * (cost / dof)[:, None, None]
+        errors = np.sqrt(np.einsum("npp->np", cov).clip(0, None))
+    y_mean = (ys * w).sum(axis=1, keepdims=True) / nsamples.clip(1, None)[:, None]
+    ss_tot = (((ys - y_mean) * w) ** 2).sum(axis=1)
+
+    # back to the original units, shifting t by t_min scales the amplitudes
+    rates = p[:, 1 : 2 * nexp : 2] / t_scale
+    amplitudes = p[:, 0 : 2 * nexp : 2] * y_scale * np.exp(rates * t_min)
+    rate_errors = errors[:, 1 : 2 * nexp : 2] / t_scale
+    # I0 = A * exp(k * t_min), so its error also depends on the covariance of A and k
+    shift = t_min / t_scale
+    amplitude_var = (
+        np.einsum("npp->np", cov)[:, 0 : 2 * nexp : 2]
+        + 2 * p[:, 0 : 2 * nexp : 2] * shift * cov[:, range(0, 2 * nexp, 2), range(1, 2 * nexp, 2)]
+        + (p[:, 0 : 2 * nexp : 2] * shift) ** 2 * np.einsum("npp->np", cov)[:, 1 : 2 * nexp : 2]
+    )
+    amplitude_errors = np.sqrt(amplitude_var.clip(0, None)) * y_scale * np.exp(rates * t_min)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        taus = 1 / rates
+        tau_errors = rate_errors / rates**2
+        r_squared = 1 - cost / ss_tot
+    if nexp == 2:
+        # fast component first
+        order = np.argsort(taus, axis=1)
+        taus, tau_errors, amplitudes, amplitude_errors = [
+            np.take_along_axis(_arr, order, axis=1)
+            for _arr in (taus, tau_errors, amplitudes, amplitude_errors)
+        ]
+
+    success = converged & np.isfinite(cost) & np.isfinite(taus).all(axis=1) & (nsamples > nparams)
+    result = {}
+    if nexp == 2:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result["I0"] = amplitudes.sum(axis=1)
+            # amplitude weighted lifetime
+            result["tau"] = (amplitudes * taus).sum(axis=1) / result["I0"]
+    names = _param_names("monoexp" if nexp == 1 else "biexp", False)
+    for i in range(nexp):
+        result[names[2 * i]] = amplitudes[:, i]
+        result[names[2 * i + 1]] = taus[:, i]
+    if include_offset:
+        result["C"] = p[:, -1] * y_scale[:, 0]
+    for i in range(nexp):
+        result[f"{names[2 * i]}_error"] = amplitude_errors[:, i]
+        result[f"{names[2 * i + 1]}_error"] = tau_errors[:, i]
+    if include_offset:
+        result["C_error"] = errors[:, -1] * y_scale[:, 0]
+    result["r_squared"] = r_squared
+    result["n_iter"] = n_iter
+    result["success"] = success
+    for _key in result:
+        if _key not in ("n_iter", "success"):
+            result[_key] = np.where(nsamples > nparams, result[_key], np.nan)
+    return result
+
+
+def _levenberg_marquardt(p, ts, ys, w, nexp, include_offset, max_iter, tol):
+    # one LM iteration for all curves still active at a time. damping is scaled by the
+    # largest diagonal of J'J seen so far (as in MINPACK) and updated from the ratio of
+    # actual to predicted reduction (Nielsen), curves converge when the cost or the step
+    # become small relative to tol. every trial step evaluates the exponentials once,
+    # the jacobian, residuals and the linear solve all reuse that basis
+    p = p.copy()
+    nparams = p.shape[1]
+    basis = _basis(p, ts, w, nexp, include_offset)
+    resid, cost = _residuals(p, ys, basis, nexp, include_offset)
+    n_iter = np.zeros(len(p), dtype="int64")
+    converged = np.zeros(len(p), dtype="bool")
+
+    # working copies of the curves still being fit, shrunk as curves finish
+    rows = np.flatnonzero(np.isfinite(cost) & (w.sum(axis=1) > nparams))
+    work = {
+        "p": p[rows],
+        "ts": ts[rows],
+        "ys": ys[rows],
+        "w": w[rows],
+        "basis": basis[rows],
+        "resid": resid[rows],
+        "cost": cost[rows],
+        "lam": np.full(len(rows), 1e-3),
+        "nu": np.full(len(rows), 2.0),
+        "scale": np.zeros((len(rows), nparams)),
+    }
+    for _ in range(max_iter):
+        if len(rows) == 0:
+            break
+        jac = _jacobian(work["p"], work["ts"], work["basis"], nexp, include_offset)
+        jtj = np.matmul(jac, jac.transpose(0, 2, 1))
+        jtr = np.matmul(jac, work["resid"][..., None])[..., 0]
+        work["scale"] = np.maximum(work["scale"], np.einsum("npp->np", jtj)).clip(1e-12, None)
+
+        damping = work["lam"][:, None] * work["scale"]
+        step = _solve(jtj + damping[:, :, None] * np.eye(nparams), jtr)
+
+        # amplitudes and offset are linear given the rates, jump to their least squares
+        # values so the iteration follows the floor of the rate/offset valley
+        new_p = work["p"] + step
+        new_basis = _basis(new_p, work["ts"], work["w"], nexp, include_offset)
+        new_p = _linear_params(new_p, work["ys"], new_basis, nexp, include_offset)
+        new_resid, new_cost = _residuals(new_p, work["ys"], new_basis, nexp, include_offset)
+        # rates must stay positive
+        new_cost[(new_p[:, 1 : 2 * nexp : 2] <= 0).any(axis=1)] = np.inf
+
+        predicted = (step * (jtr + damping * step)).sum(axis=1)
+        actual = work["cost"] - new_cost
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rho = np.where(predicted > 0, actual / predicted, -1)
+        accept = (actual > 0) & np.isfinite(new_cost)
+        step_small = (np.abs(step) <= tol * (np.abs(work["p"]) + tol)).all(axis=1)
+        for _key, _new in (
+            ("p", new_p),
+            ("basis", new_basis),
+            ("resid", new_resid),
+            ("cost", new_cost),
+        ):
+            work[_key][accept] = _new[accept]
+        work["lam"] = np.where(
+            accept,
+            work["lam"] * np.maximum(1 / 3, 1 - (2 * rho.clip(0, 1) - 1) ** 3),
+            work["lam"] * work["nu"],
+        ).clip(1e-15, 1e15)
+        work["nu"] = np.where(accept, 2, work["nu"] * 2)
+        n_iter[rows] += 1
+
+        done = (accept & (actual <= tol * work["cost"])) | step_small
+        converged[rows[done]] = True
+        finished = done | (work["lam"] >= 1e15)
+        if finished.any():
+            p[rows[finished]] = work["p"][finished]
+            cost[rows[finished]] = work["cost"][finished]
+            rows = rows[~finished]
+            work = {_key: _value[~finished] for _key, _value in work.items()}
+
+    p[rows] = work["p"]
+    cost[rows] = work["cost"]
+    return p, cost, n_iter, converged
+
+
+def _basis(p, ts, w, nexp, include_offset):
+    # (N, nexp [+ 1], T) masked exponentials of the rates in p (and the offset's ones)
+    with np.errstate(over="ignore", invalid="ignore"):
+        basis = [np.exp(-p[:, 2 * i + 1, None] * ts) * w for i in range(nexp)]
+    if include_offset:
+        basis.append(w.astype("float64"))
+    return np.stack(basis, axis=1)
+
+
+def _linear_index(nexp, include_offset):
+    return [2 * i for i in range(nexp)] + ([2 * nexp] if include_offset else [])
+
+
+def _residuals(p, ys, basis, nexp, include_offset):
+    # ys is zero where a curve has no sample, so is every basis function
+    linear = p[:, _linear_index(nexp, include_offset)]
+    with np.errstate(over="ignore", invalid="ignore"):
+        resid = ys - np.matmul(linear[:, None, :], basis)[:, 0]
+        cost = (resid**2).sum(axis=1)
+    return resid, np.where(np.isfinite(cost), cost, np.inf)
+
+
+def _linear_params(p, ys, basis, nexp, include_offset):
+    with np.errstate(over="ignore", invalid="ignore"):
+        btb = np.matmul(basis, basis.transpose(0, 2, 1))
+        bty = np.matmul(basis, ys[..., None])[..., 0]
+    ok = np.isfinite(btb).all(axis=(1, 2))
+    p = p.copy()
+    # (near) singular systems give steps that don't lower the cost and are rejected
+    p[np.ix_(ok, _linear_index(nexp, include_offset))] = _solve(btb[ok], bty[ok])
+    return p
+
+
+def _jacobian(p, ts, basis, nexp, include_offset):
+    # (N, nparams, T), d model / d parameter in the order of p
+    columns = []
+    for i in range(nexp):
+        columns.append(basis[:, i])
+        columns.append(-p[:, 2 * i, None] * ts * basis[:, i])
+    if include_offset:
+        columns.append(basis[:, -1])
+    return np.stack(columns, axis=1)
+
+
+def _solve(a, b):
+    # batched a x = b, falling back to least squares one system at a time
+    try:
+        return np.linalg.solve(a, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.stack([np.linalg.lstsq(_a, _b, rcond=None)[0] for _a, _b in zip(a, b)])
+
+
+def _split_params(p, include_offset):
+    # monoexponential (I0, k[, C]) to a biexponential start, the amplitude split between
+    # rates 3x faster and slower
+    amplitude, rate = p[:, 0], p[:, 1]
+    params = [amplitude / 2, rate * 3, amplitude / 2, rate / 3]
+    if include_offset:
+        params.append(p[:, 2])
+    return np.stack(params, axis=1)
+
+
+def _init_params(ts, ys, w, nexp, include_offset):
+    # log-linear least squares on log(y - C) for every curve at once, C just below
+    # the minimum (0 without an offset)
+    n = w.sum(axis=1).clip(1, None)
+    if include_offset:
+        y_min = np.where(w, ys, np.inf).min(axis=1)
+        y_max = np.where(w, ys, -np.inf).max(axis=1)
+        c0 = y_min - 0.05 * (y_max - y_min)
+        c0 = np.where(np.isfinite(c0), c0, 0)
+    else:
+        c0 = np.zeros(len(ys))
+    log_y = np.log(np.where(w, ys - c0[:, None], 1).clip(1e-6, None))
+    t_mean = (ts * w).sum(axis=1) / n
+    log_mean = (log_y * w).sum(axis=1) / n
+    t_var = (((ts - t_mean[:, None]) * w) ** 2).sum(axis=1)
+    cov = ((ts - t_mean[:, None]) * (log_y - log_mean[:, None]) * w).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = np.where(t_var > 0, cov / t_var, 0)
+    rate = (-slope).clip(1e-2, 1e3)
+    amplitude = np.exp(log_mean + rate * t_mean)
+
+    params = [amplitude, rate]
+    if include_offset:
+        params.append(c0)
+    params = np.stack(params, axis=1)
+    return params if nexp == 1 else _split_params(params, include_offset)
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# stage spans: wall time, CPU time, memory and array sizes of a block of work. a
+# finished span is handed to every registered sink and kept by its parent span, so a
+# stage can summarize its children (e.g. to store the summary with its output file).
+# nested spans are named parent/child. peak_rss_mb is the process high-water mark so far,
+# peak_growth_mb how much the span raised it (0 unless the span set a new peak, so the
+# stage that caused the peak is the one with growth) and rss_start_mb/rss_end_mb the
+# current RSS either side of the span
+_sinks = []
+_local = threading.local()
+
+
+def add_sink(sink):
+    # a sink is any callable taking the finished span's record (a dict)
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def log_spans_to(fname):
+    # add a JSONLinesSink for fname unless this process already has one
+    for _sink in _sinks:
+        if isinstance(_sink, JSONLinesSink) and (_sink.fname == fname):
+            return _sink
+    return add_sink(JSONLinesSink(fname))
+
+
+def current_span():
+    stack = _span_stack()
+    return stack[-1] if len(stack) > 0 else None
+
+
+@contextmanager
+def span(name, **attrs):
+    stack = _span_stack()
+    parent = stack[-1] if len(stack) > 0 else None
+    record = {
+        "name": name if parent is None else f"{parent['name']}/{name}",
+        "pid": os.getpid(),
+        "start": time.time(),
+        **attrs,
+        "arrays": {},
+        "children": [],
+    }
+    stack.append(record)
+    peak_start = peak_rss_mb()
+    record["rss_start_mb"] = rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall"] = time.perf_counter() - wall_start
+        record["cpu"] = time.process_time() - cpu_start
+        record["peak_rss_mb"] = peak_rss_mb()
+        record["rss_end_mb"] = rss_mb()
+        record["peak_growth_mb"] = (
+            None if peak_start is None else record["peak_rss_mb"] - peak_start
+        )
+        stack.pop()
+        if parent is not None:
+            parent["children"].append(record)
+        for _sink in list(_sinks):
+            try:
+                _sink(record)
+            except Exception as e:
+                print(f"Span sink failed: {e}")
+
+
+def record_array(record, name, arr):
+    # shape, dtype and size of an array (or lazy array) handled by a span
+    if (record is None) or (arr is None):
+        return
+    shape = tuple(getattr(arr, "shape", ()))
+    dtype = np.dtype(getattr(arr, "dtype", "float64"))
+    record["arrays"][name] = {
+        "shape": list(shape),
+        "dtype": dtype.str,
+        "mb": int(np.prod(shape)) * dtype.itemsize / 1024**2,
+    }
+
+
+def peak_rss_mb():
+    # peak resident set size of the process so far
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def rss_mb():
+    # current resident set size of the process, None where /proc isn't available
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def timing_summary(records):
+    # {span name: count, total wall/cpu seconds, process peak RSS and the most any one
+    # call raised it} over the children of one or more spans (all nesting levels), what
+    # gets stored with output files
+    if isinstance(records, dict):
+        records = [records]
+    summary = {}
+
+    def _add(record):
+        entry = summary.setdefault(
+            record["name"],
+            {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_mb": None, "peak_growth_mb": None},
+        )
+        entry["count"] += 1
+        entry["wall"] += record["wall"]
+        entry["cpu"] += record["cpu"]
+        if record["peak_rss_mb"] is not None:
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"] or 0, record["peak_rss_mb"])
+        if record.get("peak_growth_mb") is not None:
+            entry["peak_growth_mb"] = max(entry["peak_growth_mb"] or 0, record["peak_growth_mb"])
+        for _child in record["children"]:
+            _add(_child)
+
+    for _record in records:
+        if _record is None:
+            continue
+        for _child in _record["children"]:
+            _add(_child)
+    return summary
+
+
+def read_timing(fname):
+    # timing summary stored with an intermediate (.h5/.p) or a trace file (.parquet)
+    ext = os.path.splitext(fname)[1]
+    if ext == ".parquet":
+        import pyarrow.parquet as pq
+        from calcium_imaging_analysis.traces import metadata_key
+
+        metadata = (pq.read_schema(fname).metadata or {}).get(metadata_key)
+        return {} if metadata is None else json.loads(metadata).get("timing", {})
+    elif ext == ".h5":
+        import h5py
+
+        with h5py.File(fname, "r") as f:
+            return json.loads(f.attrs.get("timing", "{}"))
+    else:
+        import joblib
+
+        return joblib.load(fname).get("timing", {})
+
+
+class MemorySink:
+    # keeps every finished span, e.g. for notebooks and tests
+    def __init__(self):
+        self.spans = []
+
+    def __call__(self, record):
+        self.spans.append(_flat(record))
+
+
+class JSONLinesSink:
+    # appends one JSON object per finished span, safe to share between processes
+    # since each line is written with a single call on a file opened in append mode
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(_flat(record), default=str) + "\n"
+        with self._lock, open(self.fname, "a") as f:
+            f.write(line)
+
+
+class LogSink:
+    # one log line per finished span through the logging module
+    def __init__(self, logger="calcium_imaging_analysis", level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(
+            self.level,
+            "%s wall=%.3fs cpu=%.3fs peak_rss=%sMB peak_growth=%sMB",
+            record["name"],
+            record["wall"],
+            record["cpu"],
+            "n/a" if record["peak_rss_mb"] is None else f"{record['peak_rss_mb']:.0f}",
+            "n/a" if record["peak_growth_mb"] is None else f"{record['peak_growth_mb']:.0f}",
+        )
+
+
+def _span_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _flat(record):
+    # span record without its children, the children are reported by themselves
+    return {k: v for k, v in record.items() if k != "children"}
@@ -1,7 +1,14 @@
+import os
 import re
+import json
+import joblib
+import h5py
 import numpy as np
+import pandas as pd
+from functools import lru_cache
 from markovids import vid
-from calcium_imaging_analysis.viz import fluo_cmap_red
+from calcium_imaging_analysis.viz import fluo_cmap_red, stack_quantiles
+from calcium_imaging_analysis.instrument import span, current_span, record_array
 
 strip_list = [
     r"[a-z|A-Z]\.[0-9]+\_",  # well number
@@ -11,9 +18,18 @@ strip_list = [
     r"photobleachv3\_",
     r"tet\-on\_",
 ]
+strip_patterns = [re.compile(_strip) for _strip in strip_list]
+library_pattern = re.compile(r".*(s3[i]*[\_|-]l[0-9]+[\_|-][0-9]+)")
+library_tokens_pattern = re.compile(r"^(s3[i]*)[\_|-]l([0-9]+)[\_|-]([0-9]+)$")
 phase_titles = ["baseline", "ionomycin", "egta"]
+size_units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
 
+# renames applied after short_name, pass one of these (or your own) to sanitize_names
+library_aliases = {"jm34": "s3", "jm35": "s3i"}
+photobleach_aliases = {"jm27": "jrgeco1a", "jm28": "jrcamp1b", "jm56": "scarcamp"}
 
+
+@lru_cache(maxsize=65536)
 def short_name(string):
     tmp = library_name(string)
     if tmp is None:
@@ -21,13 +37,14 @@ def short_name(string):
     return tmp
 
 
+@lru_cache(maxsize=65536)
 def library_name(string):
-    tmp = re.match(r".*(s3[i]*[\_|-]l[0-9]+[\_|-][0-9]+)", string.lower())
+    tmp = library_pattern.match(string.lower())
     if tmp is None:
         return None
     else:
         match = tmp.group(1)
-        tokens = re.match(r"^(s3[i]*)[\_|-]l([0-9]+)[\_|-]([0-9]+)$", match)
+        tokens = library_tokens_pattern.match(match)
         # plate_number = int(tokens.group(0))
         base_sensor = tokens.group(1)
         library_number = int(tokens.group(2))
@@ -36,6 +53,7 @@ def library_name(string):
         return sanitized_name
 
 
+@lru_cache(maxsize=65536)
 def nonlibrary_name(string):
     use_string = string.lower()
     if "jrcamp1b" in use_string:
@@ -50,15 +68,76 @@ def nonlibrary_name(string):
         return "jrcamp1a"
     else:
         tmp = use_string
-        for _strip in strip_list:
-            tmp = re.sub(_strip, "", tmp)
+        for _strip in strip_patterns:
+            tmp = _strip.sub("", tmp)
         return tmp.split("_")[0]
 
 
-def write_video(dat, fname, phases=None, cmap=fluo_cmap_red, clims=None, movie_fps=2, **kwargs):
+def sanitize_names(names, name_func=short_name, aliases={}, categorical=True):
+    # name_func over a Series (or array/list) of names, e.g. the well column of millions
+    # of rows. only the unique names are sanitized, aliases rename the results and the
+    # output is a categorical Series with the input's index (missing names stay missing)
+    if not isinstance(names, pd.Series):
+        names = pd.Series(names)
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        codes = names.cat.codes.to_numpy()
+        uniques = names.cat.categories
+    else:
+        codes, uniques = pd.factorize(names)
+
+    sanitized = [name_func(_name) for _name in uniques]
+    sanitized = [aliases.get(_name, _name) for _name in sanitized]
+    if len(sanitized) > 0:
+        categories, inverse = np.unique(np.array(sanitized, dtype=object), return_inverse=True)
+        codes = np.where(codes >= 0, inverse[np.maximum(codes, 0)], -1)
+    else:
+        categories = np.array([], dtype=object)
+    result = pd.Series(
+        pd.Categorical.from_codes(codes, categories), index=names.index, name=names.name
+    )
+    return result if categorical else result.astype(object)
+
+
+def parse_size(size):
+    # "64G" -> bytes, plain numbers are taken as bytes
+    if size is None or isinstance(size, (int, float)):
+        return size
+    tmp = re.match(r"^\s*([0-9\.]+)\s*([kKmMgGtT]?)[bB]?\s*$", size)
+    if tmp is None:
+        raise ValueError(f"Could not parse size {size}")
+    return int(float(tmp.group(1)) * size_units[tmp.group(2).upper()])
+
+
+@span("write_video")
+def write_video(
+    dat,
+    fname,
+    phases=None,
+    cmap=fluo_cmap_red,
+    clims=None,
+    movie_fps=2,
+    chunk_size=64,
+    writer="preview",  # preview (markovids MP4WriterPreview) or stream (see write_video_stream)
+    **kwargs,
+):
 
+    record_array(current_span(), "frames", dat)
     if clims is None:
-        clims = np.quantile(dat, [0.025, 0.995])
+        clims = stack_quantiles(dat, [0.025, 0.995], chunk_size=chunk_size)
+
+    if writer == "stream":
+        return write_video_stream(
+            dat,
+            fname,
+            phases=phases,
+            cmap=cmap,
+            clims=clims,
+            movie_fps=movie_fps,
+            chunk_size=chunk_size,
+            **kwargs,
+        )
+
+    mark_frames = [] if phases is None else [_phase.start for _phase in phases.values()]
 
     # write out animation of data...
     writer_raw = vid.io.MP4WriterPreview(
@@ -69,18 +148,150 @@ def write_video(dat, fname, phases=None, cmap=fluo_cmap_red, clims=None, movie_f
         **kwargs
     )
     writer_raw.open()
-    writer_raw.write_frames(
-        dat,
-        vmin=clims[0],
-        vmax=clims[1],
-        mark_frames=(
-            [] if phases is None else [_phase.start for _phase in phases.values()]
-        ),
-        progress_bar=False,
-    )
+    if isinstance(dat, np.ndarray):
+        writer_raw.write_frames(
+            dat,
+            vmin=clims[0],
+            vmax=clims[1],
+            mark_frames=mark_frames,
+            progress_bar=False,
+        )
+    else:
+        # lazy stacks (hdf5 datasets, registered views) are read and written in chunks
+        for _start in range(0, len(dat), chunk_size):
+            _stop = min(_start + chunk_size, len(dat))
+            writer_raw.write_frames(
+                np.asarray(dat[_start:_stop]),
+                vmin=clims[0],
+                vmax=clims[1],
+                mark_frames=[_frame - _start for _frame in mark_frames if _start <= _frame < _stop],
+                progress_bar=False,
+            )
     writer_raw.close()
 
 
+def colormap_lut(cmap=fluo_cmap_red, levels=256):
+    # (levels, 3) uint8 BGR table for cv2
+    return (cmap(np.linspace(0, 1, levels))[:, 2::-1] * 255).round().astype("uint8")
+
+
+def colormap_frames(frames, clims, lut):
+    # (T, Y, X) frames -> (T, Y, X, 3) uint8 through the lookup table, no float RGB copy
+    levels = len(lut)
+    scale = (levels - 1) / max(clims[1] - clims[0], np.finfo("float64").tiny)
+    idx = np.asarray(frames, dtype="float32") - clims[0]
+    idx *= scale
+    np.clip(idx, 0, levels - 1, out=idx)
+    return lut[idx.astype("uint8" if levels <= 256 else "uint16")]
+
+
+def write_video_stream(
+    dat,
+    fname,
+    phases=None,
+    cmap=fluo_cmap_red,
+    clims=None,
+    movie_fps=2,
+    chunk_size=64,
+    threads=2,
+    preview=None,  # e.g. {"scale": 4, "step": 2}, written next to fname as *-preview.mp4
+    codec="mp4v",
+    mark_size=0.05,
+):
+    # colormaps chunk_size frames at a time with a uint8 LUT on `threads` threads while the
+    # main thread encodes, at most threads + 1 chunks are in memory whatever the length.
+    # frames where a phase starts get a white square in the top left corner
+    import cv2
+    from concurrent.futures import ThreadPoolExecutor
+
+    if clims is None:
+        clims = stack_quantiles(dat, [0.025, 0.995], chunk_size=chunk_size)
+    lut = colormap_lut(cmap)
+    mark_frames = set() if phases is None else set(_phase.start for _phase in phases.values())
+    mark = max(1, int(round(mark_size * min(dat.shape[1:3]))))
+    fourcc = cv2.VideoWriter_fourcc(*codec)
+
+    def _open(_fname, _fps, _size):
+        _writer = cv2.VideoWriter(_fname, fourcc, _fps, _size)
+        if not _writer.isOpened():
+            raise RuntimeError(f"Could not open {_fname} for writing with codec {codec}")
+        return _writer
+
+    def _render(_start):
+        _rgb = colormap_frames(dat[_start : _start + chunk_size], clims, lut)
+        for i in range(len(_rgb)):
+            if _start + i in mark_frames:
+                _rgb[i, :mark, :mark] = 255
+        return _rgb
+
+    writers = [_open(fname, movie_fps, (dat.shape[2], dat.shape[1]))]
+    if preview is not None:
+        scale = preview.get("scale", 1)
+        step = preview.get("step", 1)
+        preview_size = (max(1, dat.shape[2] // scale), max(1, dat.shape[1] // scale))
+        preview_fname = f"{os.path.splitext(fname)[0]}-preview.mp4"
+        writers.append(_open(preview_fname, movie_fps / step, preview_size))
+
+    starts = list(range(0, len(dat), chunk_size))
+    try:
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            pending = [executor.submit(_render, _start) for _start in starts[: threads + 1]]
+            for j, _start in enumerate(starts):
+                rgb = pending.pop(0).result()
+                if j + threads + 1 < len(starts):
+                    pending.append(executor.submit(_render, starts[j + threads + 1]))
+                for i, _frame in enumerate(rgb):
+                    writers[0].write(_frame)
+                    if (preview is not None) and ((_start + i) % step == 0):
+                        writers[1].write(
+                            cv2.resize(_frame, preview_size, interpolation=cv2.INTER_AREA)
+                        )
+    finally:
+        for _writer in writers:
+            _writer.release()
+
+
+def nd2_well_view(f, well_name=None, wells=[]):
+    # lazy (dask-backed) view of a single well from an open ND2File, frames are only
+    # read from disk once the view (or a slice of it) is computed
+    arr = f.to_dask()
+    dim_names = list(f.sizes.keys())
+    if ("P" in dim_names) and (well_name in wells):
+        arr = take_lazy(arr, wells.index(well_name), axis=dim_names.index("P"))
+        del dim_names[dim_names.index("P")]
+    return arr, dim_names
+
+
+def nd2_well_names(f):
+    # names of the XYPosLoop positions in an open ND2File, empty if there's no loop
+    for _experiment in f.experiment:
+        if _experiment.type == "XYPosLoop":
+            return [_.name for _ in _experiment.parameters.points]
+    return []
+
+
+def take_lazy(arr, idx, axis):
+    # equivalent to arr.take(idx, axis=axis), but keeps dask arrays lazy
+    return arr[(slice(None),) * axis + (idx,)]
+
+
+def nd2_event_table(events):
+    # columnar version of ND2File.events(), one row per event, missing keys become NaN
+    return pd.DataFrame.from_records(events)
+
+
+def nd2_event_times(event_table, position_index=0):
+    # timestamp of each T Index for a single position, indexed by T Index
+    # (if an index repeats keep the last event, same as a sequential scan)
+    if ("P Index" not in event_table.columns) or ("T Index" not in event_table.columns):
+        return pd.Series(dtype="float")
+    position_events = event_table.loc[
+        (event_table["P Index"] == position_index) & event_table["T Index"].notna()
+    ]
+    return position_events.groupby("T Index")["Time [s]"].last()
+
+
+@span("nd2_metadata")
 def nd2_metadata_parse(img):
     import nd2
 
@@ -99,18 +310,17 @@ def nd2_metadata_parse(img):
         # arr = f.asarray()
         dim_sizes = f.sizes
 
+    event_table = nd2_event_table(events)
     if len(wells) > 0:
-        timesteps = {}
-        for _well in wells:
-            timesteps[_well] = np.array(
-                [
-                    _["Time [s]"]
-                    for _ in events
-                    if ("Position Name" in _.keys()) and (_["Position Name"] == _well)
-                ]
-            )
+        timesteps = {_well: np.array([]) for _well in wells}
+        if "Position Name" in event_table.columns:
+            for _well, _times in event_table.groupby("Position Name", sort=False)["Time [s]"]:
+                if _well in timesteps:
+                    timesteps[_well] = _times.to_numpy()
+    elif "T Index" in event_table.columns:
+        timesteps = event_table.loc[event_table["T Index"].notna(), "Time [s]"].to_numpy()
     else:
-        timesteps = np.array([_["Time [s]"] for _ in events if "T Index" in _.keys()])
+        timesteps = np.array([])
 
     return_dct = {
         "dim_sizes": dim_sizes,
@@ -118,7 +328,247 @@ def nd2_metadata_parse(img):
         "channel_names": channel_names,
         "phase_lens": phase_lens,
         "events": events,
+        "event_table": event_table,
         "wells": wells,
         # "frames": arr
     }
     return return_dct
+
+
+# registration outputs, newest format first
+intermediate_extensions = [".h5", ".p"]
+intermediate_attrs = [
+    "experiment_type",
+    "well_name",
+    "well_scan",
+    "registration_comparison",
+    "transform",
+    "source_file",
+    "source_well",
+    "timing",
+]
+
+
+def find_intermediate(base_fname):
+    # return the registration output for a path without extension, None if there isn't one
+    # unreadable files (e.g. left behind by a run killed by an older version) count as missing
+    for _ext in intermediate_extensions:
+        fname = f"{base_fname}{_ext}"
+        if os.path.exists(fname):
+            if intermediate_readable(fname):
+                return fname
+            print(f"Unreadable intermediate {fname}, treating it as missing")
+    return None
+
+
+def intermediate_readable(fname):
+    # cheap check that doesn't load the frames, hdf5 files must open, pickles be non-empty
+    if os.path.splitext(fname)[1] == ".p":
+        return os.path.getsize(fname) > 0
+    try:
+        with h5py.File(fname, "r"):
+            return True
+    except OSError:
+        return False
+
+
+@span("save_intermediate")
+def save_intermediate(fname, data_dct, compression="lzf", chunk_frames=8):
+    # chunked hdf5 layout, one (T, Y, X) dataset per channel chunked by frame so a single
+    # channel or a range of frames can be read without touching the rest of the file.
+    # everything small is stored as attributes or small datasets
+    # written to a temporary file and moved into place, so a killed run never leaves a
+    # truncated intermediate that looks finished
+    record_array(current_span(), "registered_frames", data_dct.get("registered_frames"))
+    tmp_fname = f"{fname}.tmp"
+    if os.path.splitext(fname)[1] == ".p":
+        joblib.dump(data_dct, tmp_fname, compress="lz4")
+    else:
+        _write_intermediate_h5(tmp_fname, data_dct, compression, chunk_frames)
+    os.replace(tmp_fname, fname)
+
+
+@span("load_intermediate")
+def load_intermediate(fname, channel=None, frames=None, lazy=False):
+    # load registration output from either format. if channel (a name, or list of names
+    # to try in order) is given only that channel is returned as a (T, Y, X) array,
+    # otherwise all channels as (C, T, Y, X). frames selects a slice/range of frames.
+    # with lazy=True registered_frames is left as an h5py Dataset (or RegisteredView if
+    # only transforms were stored), a list of them if no channel is given. if frames is
+    # given as well only those frames are read
+    if isinstance(channel, str):
+        channel = [channel]
+    if frames is None:
+        frames = slice(None)
+    elif isinstance(frames, range):
+        frames = slice(frames.start, frames.stop)
+
+    if os.path.splitext(fname)[1] == ".p":
+        data_dct = joblib.load(fname)
+        if len(data_dct) == 0:
+            return data_dct
+        data_dct["channel"] = None
+        data_dct.setdefault("registered_aux_image", None)
+        if data_dct.get("registered_frames") is not None:
+            channel_frames = data_dct["registered_frames"]
+        else:
+            channel_frames = _registered_views(fname, data_dct)
+        _select_frames(data_dct, channel_frames, channel, frames, lazy)
+        return data_dct
+
+    f = h5py.File(fname, "r")
+    keep_open = False
+    try:
+        if "timesteps" not in f:
+            return {}
+
+        phase_names = json.loads(f.attrs["phase_names"])
+        data_dct = {
+            "roi_masks": f["roi_masks"][()],
+            "timesteps": f["timesteps"][()],
+            "phases": {
+                _name: range(int(_start), int(_stop))
+                for _name, (_start, _stop) in zip(phase_names, f["phase_ranges"][()])
+            },
+            "phases_first_timestep": json.loads(f.attrs["phases_first_timestep"]),
+            "channels": json.loads(f.attrs["channels"]),
+            "registered_aux_image": (
+                f["registered_aux_image"][()] if "registered_aux_image" in f else None
+            ),
+            "channel": None,
+        }
+        for _key in intermediate_attrs:
+            if _key in f.attrs:
+                data_dct[_key] = json.loads(f.attrs[_key])
+        data_dct["event_table"] = pd.DataFrame(
+            {
+                _col: (
+                    _dset.asstr()[()] if h5py.check_string_dtype(_dset.dtype) else _dset[()]
+                )
+                for _col, _dset in f["events"].items()
+            }
+        )
+        data_dct["events"] = data_dct["event_table"].to_dict("records")
+        if "tmats" in f:
+            data_dct["tmats"] = f["tmats"][()]
+            data_dct["source_file_relative"] = f.attrs["source_file_relative"]
+
+        if "registered_frames" in f:
+            channel_frames = [
+                f["registered_frames"][str(i)] for i in range(len(data_dct["channels"]))
+            ]
+        else:
+            channel_frames = _registered_views(fname, data_dct)
+        _select_frames(data_dct, channel_frames, channel, frames, lazy)
+        # lazy datasets keep their own reference to the file
+        selected = data_dct["registered_frames"]
+        keep_open = any(
+            isinstance(_frames, h5py.Dataset)
+            for _frames in (selected if isinstance(selected, list) else [selected])
+        )
+    finally:
+        if not keep_open:
+            f.close()
+    return data_dct
+
+
+def _write_intermediate_h5(fname, data_dct, compression="lzf", chunk_frames=8):
+    with h5py.File(fname, "w") as f:
+        if len(data_dct) == 0:
+            return
+
+        if data_dct.get("registered_frames") is not None:
+            frames = f.create_group("registered_frames")
+            for i, _frames in enumerate(data_dct["registered_frames"]):
+                frames.create_dataset(
+                    str(i),
+                    data=_frames,
+                    chunks=(min(chunk_frames, len(_frames)),) + _frames.shape[1:],
+                    compression=compression,
+                )
+        if data_dct.get("tmats") is not None:
+            f.create_dataset("tmats", data=data_dct["tmats"])
+            f.attrs["source_file_relative"] = os.path.relpath(
+                data_dct["source_file"], os.path.dirname(os.path.abspath(fname))
+            )
+
+        f.create_dataset("roi_masks", data=data_dct["roi_masks"], compression=compression)
+        f.create_dataset("timesteps", data=np.asarray(data_dct["timesteps"], dtype="float64"))
+        if data_dct.get("registered_aux_image") is not None:
+            f.create_dataset("registered_aux_image", data=data_dct["registered_aux_image"])
+
+        phases = data_dct["phases"]
+        f.create_dataset(
+            "phase_ranges",
+            data=np.array([[_range.start, _range.stop] for _range in phases.values()], dtype="int64").reshape(-1, 2),
+        )
+        f.attrs["phase_names"] = json.dumps(list(phases.keys()))
+        f.attrs["phases_first_timestep"] = json.dumps(
+            {k: float(v) for k, v in data_dct["phases_first_timestep"].items()}
+        )
+        f.attrs["channels"] = json.dumps(list(data_dct["channels"]))
+        for _key in intermediate_attrs:
+            if _key in data_dct:
+                f.attrs[_key] = json.dumps(data_dct[_key], default=float)
+
+        event_table = nd2_event_table(data_dct.get("events", []))
+        events = f.create_group("events")
+        for _col in event_table.columns:
+            if event_table[_col].dtype.kind in "biuf":
+                events.create_dataset(_col, data=event_table[_col].to_numpy(dtype="float64"))
+            else:
+                events.create_dataset(
+                    _col,
+                    data=event_table[_col].astype(str).to_numpy(dtype=object),
+                    dtype=h5py.string_dtype(),
+                )
+
+
+def _select_frames(data_dct, channel_frames, channel, frames, lazy):
+    # lazy only leaves the datasets as they are if all frames are asked for
+    lazy = lazy and isinstance(frames, slice) and (frames == slice(None))
+    if channel is not None:
+        use_channel = _find_channel(data_dct["channels"], channel)
+        if use_channel is None:
+            data_dct["registered_frames"] = None
+        else:
+            data_dct["channel"] = data_dct["channels"][use_channel]
+            data_dct["registered_frames"] = (
+                channel_frames[use_channel] if lazy else np.asarray(channel_frames[use_channel][frames])
+            )
+    elif lazy:
+        data_dct["registered_frames"] = list(channel_frames)
+    else:
+        data_dct["registered_frames"] = np.array([_frames[frames] for _frames in channel_frames])
+
+
+def _registered_views(fname, data_dct):
+    # frames weren't saved, warp the raw data on demand with the stored transforms
+    from calcium_imaging_analysis.registration import RegisteredView
+
+    source_file = data_dct["source_file"]
+    if "source_file_relative" in data_dct:
+        relative_file = os.path.normpath(
+            os.path.join(os.path.dirname(os.path.abspath(fname)), data_dct["source_file_relative"])
+        )
+        if os.path.exists(relative_file):
+            source_file = relative_file
+    return [
+        RegisteredView(
+            source_file,
+            data_dct["tmats"],
+            transform=data_dct.get("transform", "rigid_body"),
+            well_name=data_dct.get("source_well"),
+            channel=i,
+        )
+        for i in range(len(data_dct["channels"]))
+    ]
+
+
+def _find_channel(channels, preferences):
+    for _channel in preferences:
+        try:
+            return channels.index(_channel)
+        except ValueError:
+            pass
+    return None
@@ -0,0 +1,572 @@
+import os
+import time
+import mmap
+import fnmatch
+import argparse
+import threading
+import collections
+import numpy as np
+import pandas as pd
+from calcium_imaging_analysis.io import short_name, nd2_well_names, _find_channel
+from calcium_imaging_analysis.registration import (
+    IncrementalRegistration,
+    experiment_phases,
+    model_eval_kwargs,
+)
+from calcium_imaging_analysis.segmentation import segment
+from calcium_imaging_analysis.traces import (
+    roi_pixel_index,
+    roi_means,
+    phase_frames,
+    build_traces,
+    compact_traces,
+    write_traces,
+)
+from calcium_imaging_analysis.baseline import streaming_f0
+from calcium_imaging_analysis.instrument import span
+
+# live acquisition mode: frames are registered, reduced to ROI means and dF/F0 as they
+# arrive instead of after the acquisition. every new frame is registered to the previous
+# one, ROI masks are fixed once the first mask_frames frames are in (segmented from their
+# max projection unless masks are given) and F0 is updated frame by frame (see
+# baseline.streaming_f0), so the work per frame doesn't grow with the recording. frames
+# come from a source, anything with a poll() returning the new (t, frame) pairs:
+#   FolderSource  one file per frame written into a folder (simulate_acquisition writes one)
+#   ND2Source     one well of an ND2 file that is still being written
+
+
+class LiveTraces:
+    def __init__(
+        self,
+        masks=None,  # fixed ROI masks, default segments the first mask_frames frames
+        roi_channel=["FITC", "TRITC", "mCherry"],  # registered and segmented, names or an index
+        data_channel=["mCherry"],  # traces are extracted from this channel
+        channels=None,  # channel names of the frames, set from the source by watch
+        transform="rigid_body",
+        registration_downsample=1,
+        registration_crop=None,
+        mask_frames=20,
+        cellpose_model="cyto2",
+        model_eval_kwargs=model_eval_kwargs,
+        mask_cache_dir=None,
+        baseline="first",  # first or rolling_quantile (trailing window)
+        baseline_kwargs={},
+        phases={},  # default from the source's planned phase lengths, if it has them
+        experiment_type="photoswitch",
+        name=None,  # well name for the well/well_sanitized columns
+        capacity=1024,  # frames preallocated, doubled whenever it runs out
+    ):
+        self.roi_channel = roi_channel
+        self.data_channel = data_channel
+        self.channels = channels
+        self.registration = IncrementalRegistration(
+            transform, downsample=registration_downsample, crop=registration_crop
+        )
+        self.mask_frames = mask_frames
+        self.cellpose_model = cellpose_model
+        self.model_eval_kwargs = model_eval_kwargs
+        self.mask_cache_dir = mask_cache_dir
+        self.baseline = baseline
+        self.baseline_kwargs = baseline_kwargs
+        self.phases = phases
+        self.experiment_type = experiment_type
+        self.name = name
+
+        self.nframes = 0  # frames registered
+        self.ntraced = 0  # frames with ROI means, lags nframes until the masks are fixed
+        self.max_proj = None
+        self.masks = None
+        self.roi_index = None
+        self._t = np.full(capacity, np.nan)
+        self._values = None
+        self._dff0 = None
+        self._f0 = None
+        self._pending = []  # registered data frames waiting for the masks
+        self._use_channels = None
+        if masks is not None:
+            self.set_masks(masks)
+
+    def add_frame(self, frame, t=np.nan):
+        # register one (C, Y, X) or (Y, X) frame and update the traces
+        frame = np.asarray(frame)
+        if frame.ndim == 2:
+            frame = frame[None]
+        if self._use_channels is None:
+            self._use_channels = (
+                resolve_channel(self.channels, self.roi_channel),
+                resolve_channel(self.channels, self.data_channel),
+            )
+        roi_channel, data_channel = self._use_channels
+
+        tmat = self.registration.update(frame[roi_channel])
+        data = self.registration.transform(frame[data_channel], tmat)
+        self._t = _grow(self._t, self.nframes + 1)
+        self._t[self.nframes] = t
+        self.nframes += 1
+
+        if self.roi_index is not None:
+            self._append(roi_means(data[None], self.roi_index)[0])
+            return
+
+        # still collecting the frames the masks are segmented from
+        if roi_channel == data_channel:
+            roi = data
+        else:
+            roi = self.registration.transform(frame[roi_channel], tmat)
+        self.max_proj = roi if self.max_proj is None else np.maximum(self.max_proj, roi)
+        self._pending.append(data)
+        if len(self._pending) >= self.mask_frames:
+            print(f"Segmenting the max projection of frames 0-{len(self._pending) - 1}")
+            self.set_masks(
+                segment(
+                    self.max_proj,
+                    model_type=self.cellpose_model,
+                    model_eval_kwargs=self.model_eval_kwargs,
+                    cache_dir=self.mask_cache_dir,
+                )
+            )
+
+    def set_masks(self, masks):
+        # fix the ROIs, frames registered so far are reduced with them right away
+        self.masks = np.asarray(masks)
+        self.roi_index = roi_pixel_index(self.masks)
+        nrois = len(self.roi_index["labels"])
+        self._values = np.full((len(self._t), nrois), np.nan)
+        self._dff0 = np.full((len(self._t), nrois), np.nan)
+        self._f0 = streaming_f0(nrois, method=self.baseline, **self.baseline_kwargs)
+        print(f"Tracking {nrois} ROIs")
+        pending = self._pending
+        self._pending = []
+        for _data in pending:
+            self._append(roi_means(_data[None], self.roi_index)[0])
+
+    def _append(self, row):
+        n = self.ntraced
+        self._values = _grow(self._values, n + 1)
+        self._dff0 = _grow(self._dff0, n + 1)
+        self._values[n] = row
+        f0 = self._f0.update(row)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._dff0[n - self._f0.revised : n + 1] = (
+                self._values[n - self._f0.revised : n + 1] - f0
+            ) / f0
+        self.ntraced += 1
+
+    def traces(self):
+        # long traces of the frames so far, the same columns proc_photoswitch returns
+        n = self.ntraced
+        t = self._t[:n]
+        phases_first_timestep = {
+            _name: t[_range.start] for _name, _range in self.phases.items() if _range.start < n
+        }
+        frames = phase_frames(t, self.phases, phases_first_timestep)
+        frame_number = frames["frame_number"].to_numpy()
+        values = np.zeros((0, 0)) if self._values is None else self._values
+        dff0 = np.zeros((0, 0)) if self._dff0 is None else self._dff0
+        traces = build_traces(frames, values[frame_number])
+        if self.name is not None:
+            traces["well"] = self.name
+            traces["well_sanitized"] = short_name(self.name)
+        traces["value_dff0"] = dff0[frame_number].T.ravel()
+        return compact_traces(traces)
+
+    def status(self):
+        # mean dF/F0 over ROIs in every phase so far, one line to follow the acquisition by
+        n = self.ntraced
+        if (n == 0) or (self._dff0.shape[1] == 0):
+            return f"{self.nframes} frames, no traces yet"
+        frames = phase_frames(self._t[:n], self.phases)
+        dff0 = self._dff0[frames["frame_number"].to_numpy()]
+        frame_dff0 = pd.DataFrame(np.where(np.isfinite(dff0), dff0, np.nan)).mean(axis=1)
+        phase_dff0 = frame_dff0.groupby(frames["phase"].to_numpy(), sort=False).mean()
+        return f"{self.nframes} frames, {self._dff0.shape[1]} ROIs, mean dF/F0 " + ", ".join(
+            f"{_phase}={_dff0:.3f}" for _phase, _dff0 in phase_dff0.items()
+        )
+
+    def write(self, fname, layout="wide"):
+        # traces so far (and the masks next to them, as <name>-masks.npy)
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        write_traces(
+            self.traces(),
+            fname,
+            layout=layout,
+            metadata={
+                "experiment_type": self.experiment_type,
+                "live": True,
+                "nframes": self.nframes,
+            },
+        )
+        if self.masks is not None:
+            np.save(f"{os.path.splitext(fname)[0]}-masks.npy", self.masks)
+
+
+class FolderSource:
+    # frames written one file per frame (.npy, or images skimage can read) into a folder,
+    # in file name order. t is frame_interval * frame number if given, otherwise the
+    # modification time relative to the first file. numbered frames are found by probing
+    # the name after the last one (its number + 1) rather than listing the folder, so a
+    # poll doesn't get slower as frames pile up
+    def __init__(self, folder, pattern="*.npy", frame_interval=None):
+        self.folder = folder
+        self.pattern = pattern
+        self.frame_interval = frame_interval
+        self.channels = None
+        self.phase_lens = []
+        self.nframes = 0
+        self._start = None
+        self._last = None  # name of the last frame read
+        self._read_time = None
+        self._queue = collections.deque()  # names found by the last listing, not read yet
+        self._listed = None  # folder modification time at the last listing
+
+    def poll(self):
+        new = []
+        while True:
+            name = self._next_name()
+            if name is None:
+                break
+            fname = os.path.join(self.folder, name)
+            try:
+                frame = _read_frame_file(fname)
+                mtime = os.path.getmtime(fname)
+            except (OSError, ValueError, EOFError):
+                # still being written, picked up again on the next poll
+                break
+            if self._start is None:
+                self._start = mtime
+            if self.frame_interval is None:
+                t = mtime - self._start
+            else:
+                t = self.nframes * self.frame_interval
+            new.append((t, frame))
+            self.nframes += 1
+            self._last = name
+            self._read_time = time.time()
+            if (len(self._queue) > 0) and (self._queue[0] == name):
+                self._queue.popleft()
+        return new
+
+    def _next_name(self):
+        if len(self._queue) > 0:
+            return self._queue[0]
+        name = None if self._last is None else _increment_name(self._last)
+        if (name is not None) and (name > self._last) and fnmatch.fnmatch(name, self.pattern):
+            if os.path.isfile(os.path.join(self.folder, name)):
+                return name
+            if time.time() - self._read_time < 5:
+                # not written yet. the folder is only listed once it hasn't shown up for a
+                # while, in case the numbering skips
+                return None
+        try:
+            mtime = os.stat(self.folder).st_mtime
+        except OSError:
+            return None
+        # file system times can be coarser than the time between frames, a folder changed
+        # in the last couple of seconds is listed again in case it changed since
+        if (mtime == self._listed) and (time.time() - mtime > 2):
+            return None
+        self._listed = mtime
+        with os.scandir(self.folder) as it:
+            names = [
+                _entry.name
+                for _entry in it
+                if fnmatch.fnmatch(_entry.name, self.pattern)
+                and ((self._last is None) or (_entry.name > self._last))
+            ]
+        self._queue.extend(sorted(names))
+        return self._queue[0] if len(self._queue) > 0 else None
+
+
+class ND2Source:
+    # frames of one well of an ND2 file while it's being acquired. the file stays open, every
+    # poll re-reads its chunk map (where the frames written so far are) and only the frames
+    # after the last one read are touched. that goes through private attributes of nd2's
+    # reader, if they aren't there the file is reopened on every poll instead
+    def __init__(self, path, well_name=None):
+        self.path = path
+        self.well_name = well_name
+        self.channels = None
+        self.phase_lens = []
+        self.nframes = 0
+        self._file = None
+        self._loop_sizes = None
+        self._coords = None
+        self._reopen = False
+
+    def poll(self):
+        if self._reopen:
+            self.close()
+        if self._file is None:
+            try:
+                self._open()
+            except Exception:
+                # not created yet or the header isn't written, try again on the next poll
+                self.close()
+                return []
+        f = self._file
+        try:
+            written = None if self._reopen else _nd2_written_frames(f)
+            if written is None:
+                if not self._reopen:
+                    print("Unknown nd2 reader, reopening the file on every poll")
+                    self._reopen = True
+                # the file was just opened, the frame count it reports is current
+                written = range(f.attributes.sequenceCount)
+        except Exception:
+            # chunk map is being rewritten, try again on the next poll
+            return []
+        new = []
+        coords = self._coords
+        while self.nframes < self._loop_sizes["T"]:
+            coords["T"] = self.nframes
+            sequence = int(
+                np.ravel_multi_index(list(coords.values()), list(self._loop_sizes.values()))
+            )
+            if sequence not in written:
+                break
+            try:
+                t = f.frame_metadata(sequence).channels[0].time.relativeTimeMs / 1000
+            except Exception:
+                t = np.nan
+            # copied, the frame would otherwise be a view of the file's memory map
+            new.append((t, np.array(f.read_frame(sequence))))
+            self.nframes += 1
+        return new
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        import nd2
+
+        self._file = f = nd2.ND2File(self.path)
+        if self.channels is None:
+            self.channels = [_.channel.name for _ in f.metadata.channels]
+            for _experiment in f.experiment:
+                if _experiment.type == "NETimeLoop":
+                    self.phase_lens = [_.count for _ in _experiment.parameters.periods]
+
+        # sequence index of (t, well, first z) in the acquisition loops
+        wells = nd2_well_names(f)
+        self._loop_sizes = {_dim: _size for _dim, _size in f.sizes.items() if _dim not in "CYXS"}
+        self._loop_sizes.setdefault("T", 1)
+        self._coords = {_dim: 0 for _dim in self._loop_sizes}
+        if ("P" in self._coords) and (self.well_name in wells):
+            self._coords["P"] = wells.index(self.well_name)
+
+
+def resolve_channel(channels, preferences):
+    # index of the first of preferences (names or indexes) found in channels
+    if isinstance(preferences, (str, int, np.integer)):
+        preferences = [preferences]
+    for _preference in preferences:
+        if isinstance(_preference, (int, np.integer)) or str(_preference).isdigit():
+            return int(_preference)
+    if channels is None:
+        print(f"No channel names, using channel 0 for {preferences}")
+        return 0
+    use_channel = _find_channel(channels, list(preferences))
+    if use_channel is None:
+        raise RuntimeError(f"None of {list(preferences)} in channels {channels}")
+    return use_channel
+
+
+@span("live_watch")
+def watch(
+    source,
+    live=None,
+    poll_interval=1.0,
+    timeout=60.0,  # stop after this many seconds without new frames
+    max_frames=None,
+    output=None,  # parquet file rewritten every write_interval seconds and at the end
+    write_interval=30.0,
+    report_interval=10.0,
+    on_frame=None,  # on_frame(live) after every frame, e.g. to update a plot
+    **kwargs,  # LiveTraces options if live isn't given
+):
+    if live is None:
+        live = LiveTraces(**kwargs)
+    last_frame = last_write = last_report = time.time()
+    try:
+        while (max_frames is None) or (live.nframes < max_frames):
+            new = source.poll()
+            if (len(new) > 0) and (live.nframes == 0):
+                if live.channels is None:
+                    live.channels = source.channels
+                if (len(live.phases) == 0) and (len(source.phase_lens) > 0):
+                    live.phases = experiment_phases(source.phase_lens, live.experiment_type)
+            for _t, _frame in new[: None if max_frames is None else max_frames - live.nframes]:
+                live.add_frame(_frame, _t)
+                if on_frame is not None:
+                    on_frame(live)
+
+            now = time.time()
+            if len(new) > 0:
+                last_frame = now
+            elif now - last_frame > timeout:
+                print(f"No new frames for {timeout}s, stopping")
+                break
+            if now - last_report > report_interval:
+                print(live.status())
+                last_report = now
+            if (output is not None) and (now - last_write > write_interval) and (live.ntraced > 0):
+                live.write(output)
+                last_write = now
+            if len(new) == 0:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped")
+    if hasattr(source, "close"):
+        source.close()
+    print(live.status())
+    if (output is not None) and (live.ntraced > 0):
+        live.write(output)
+    elif output is not None:
+        print(f"No frames traced, nothing written to {output}")
+    return live
+
+
+def simulate_acquisition(frames, folder, interval=0.1, prefix="frame", background=False):
+    # local stand-in for an acquisition: writes frames (anything indexable by frame, e.g. a
+    # (T, C, Y, X) array or memmap) into folder one .npy every interval seconds. files are
+    # written under a temporary name and renamed, so readers never see half a frame
+    os.makedirs(folder, exist_ok=True)
+
+    def _write():
+        for i in range(len(frames)):
+            fname = os.path.join(folder, f"{prefix}_{i:06d}.npy")
+            with open(f"{fname}.tmp", "wb") as f:
+                np.save(f, np.asarray(frames[i]))
+            os.replace(f"{fname}.tmp", fname)
+            time.sleep(interval)
+
+    if background:
+        thread = threading.Thread(target=_write, daemon=True)
+        thread.start()
+        return thread
+    _write()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Register and extract traces from an acquisition while it's running"
+    )
+    parser.add_argument("path", help="ND2 file being acquired, or a folder frames are written into")
+    parser.add_argument("--well", default=None, help="well to follow in a multi-well ND2 file")
+    parser.add_argument("--pattern", default="*.npy", help="frame files to read from a folder")
+    parser.add_argument("--frame-interval", type=float, default=None, help="seconds between frames written to a folder (default file times)")
+    parser.add_argument("--experiment-type", default="photoswitch", choices=["photoswitch", "timecourse", "other"])
+    parser.add_argument("--roi-channel", nargs="+", default=["FITC", "TRITC", "mCherry"], help="channel names or indexes")
+    parser.add_argument("--data-channel", nargs="+", default=["mCherry"], help="channel names or indexes")
+    parser.add_argument("--masks", default=None, help=".npy file with ROI masks to use instead of segmenting")
+    parser.add_argument("--mask-frames", type=int, default=20, help="frames whose max projection is segmented")
+    parser.add_argument("--registration-downsample", type=int, default=1)
+    parser.add_argument("--baseline", default="first", choices=["first", "rolling_quantile"])
+    parser.add_argument("--baseline-frames", type=int, default=20, help="frames F0 is the median of (first)")
+    parser.add_argument("--baseline-window", type=int, default=10, help="trailing window (rolling_quantile)")
+    parser.add_argument("--baseline-quantile", type=float, default=0.1, help="quantile (rolling_quantile)")
+    parser.add_argument("--output", default=None, help="trace file (default _live/<name>.parquet next to path)")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=60.0, help="stop after this many seconds without new frames")
+    parser.add_argument("--write-interval", type=float, default=30.0)
+    parser.add_argument("--simulate", default=None, metavar="NPY", help="replay a (T, [C,] Y, X) .npy stack into the folder")
+    parser.add_argument("--simulate-interval", type=float, default=0.1)
+    args = parser.parse_args(args)
+
+    if os.path.splitext(args.path)[1].lower() == ".nd2":
+        source = ND2Source(args.path, well_name=args.well)
+        name = args.well if args.well is not None else os.path.splitext(os.path.basename(args.path))[0]
+    else:
+        source = FolderSource(args.path, pattern=args.pattern, frame_interval=args.frame_interval)
+        name = os.path.basename(os.path.normpath(args.path))
+    output = args.output
+    if output is None:
+        output = os.path.join(
+            os.path.dirname(os.path.abspath(os.path.normpath(args.path))), "_live", f"{name}.parquet"
+        )
+
+    if args.baseline == "first":
+        baseline_kwargs = {"nframes": args.baseline_frames}
+    else:
+        baseline_kwargs = {"window": args.baseline_window, "quantile": args.baseline_quantile}
+
+    if args.simulate is not None:
+        simulate_acquisition(
+            np.load(args.simulate, mmap_mode="r"),
+            args.path,
+            interval=args.simulate_interval,
+            background=True,
+        )
+
+    live = watch(
+        source,
+        poll_interval=args.poll_interval,
+        timeout=args.timeout,
+        output=output,
+        write_interval=args.write_interval,
+        masks=None if args.masks is None else np.load(args.masks),
+        roi_channel=args.roi_channel,
+        data_channel=args.data_channel,
+        mask_frames=args.mask_frames,
+        registration_downsample=args.registration_downsample,
+        baseline=args.baseline,
+        baseline_kwargs=baseline_kwargs,
+        experiment_type=args.experiment_type,
+        name=name,
+    )
+    if live.ntraced > 0:
+        print(f"Traces written to {output}")
+
+
+def _grow(arr, n):
+    # room for n rows, capacity doubles so appending is O(1) amortized
+    if n <= len(arr):
+        return arr
+    grown = np.full((max(2 * len(arr), n),) + arr.shape[1:], np.nan)
+    grown[: len(arr)] = arr
+    return grown
+
+
+def _increment_name(name):
+    # frame_000041.npy -> frame_000042.npy, None if the name has no number
+    stem, ext = os.path.splitext(name)
+    digits = len(stem) - len(stem.rstrip("0123456789"))
+    if digits == 0:
+        return None
+    number = str(int(stem[-digits:]) + 1).zfill(digits)
+    return f"{stem[:-digits]}{number}{ext}"
+
+
+def _nd2_written_frames(f):
+    # sequence indexes of the frames in the file so far. the reader keeps the chunk map and
+    # a memory map of the file as they were when it was opened, both are refreshed. these
+    # are private attributes of nd2's (v3 file) reader as of nd2 0.12, None without them
+    rdr = getattr(f, "_rdr", None)
+    if not (
+        all(hasattr(rdr, _attr) for _attr in ("_chunkmap", "_cached_frame_offsets", "_fh", "_mmap"))
+        and hasattr(type(rdr), "chunkmap")
+    ):
+        return None
+    rdr._chunkmap = None
+    rdr._cached_frame_offsets = None
+    size = os.fstat(rdr._fh.fileno()).st_size
+    if (rdr._mmap is not None) and (size > len(rdr._mmap)):
+        # the old map is closed once nothing refers to it anymore
+        rdr._mmap = mmap.mmap(rdr._fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return {
+        int(_key[13:-1]) for _key in rdr.chunkmap if _key.startswith(b"ImageDataSeq|")
+    }
+
+
+def _read_frame_file(fname):
+    if os.path.splitext(fname)[1] == ".npy":
+        return np.load(fname)
+    from skimage.io import imread
+
+    return imread(fname)
+
+
+if __name__ == "__main__":
+    main()
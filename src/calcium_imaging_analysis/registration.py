@@ -1,15 +1,34 @@
 import numpy as np
+import pandas as pd
 import nd2
 import os
 import joblib
+import tempfile
+from contextlib import nullcontext
 from calcium_imaging_analysis.viz import fluo_cmap_red, label_cmap
-from calcium_imaging_analysis.io import nd2_metadata_parse
+from calcium_imaging_analysis.io import (
+    nd2_metadata_parse,
+    nd2_event_times,
+    nd2_well_view,
+    nd2_well_names,
+    take_lazy,
+    find_intermediate,
+    save_intermediate,
+    parse_size,
+)
 from pystackreg import StackReg
-from cellpose import models
+from calcium_imaging_analysis.segmentation import segment
+from calcium_imaging_analysis.instrument import (
+    span,
+    current_span,
+    record_array,
+    timing_summary,
+)
 
 phase_titles_timecourse = ["baseline", "ionomycin", "egta"]
 model_eval_kwargs = {"diameter": 80, "cellprob_threshold": 0.9, "channels": [[0, 0]]}
 
+@span("register_and_get_rois")
 def register_and_get_rois(
     img,
     cellpose_model="cyto2",
@@ -18,18 +37,72 @@ def register_and_get_rois(
     well_name=None,  # only used for multi-well files
     roi_channel=["FITC", "TRITC", "mCherry"],  # use channels in this order for ROI
     experiment_type="timecourse",
+    metadata=None,  # pass in pre-parsed metadata to skip re-parsing the file
+    nd2_file=None,  # pass in an open ND2File to skip re-opening the file
+    mask_cache_dir="default",  # None to disable, default is _analysis/_mask_cache
+    registration_downsample=1,  # estimate transforms on a downsampled stack
+    registration_crop=None,  # (y0, y1, x0, x1) estimate transforms on a cropped stack
+    registration_threads=1,  # warp channels in parallel
+    compare_registration=False,  # also register at full res and report the difference
+    output_format="h5",  # h5 (chunked hdf5) or p (legacy lz4 joblib pickle)
+    save_registered_frames=True,  # False stores only transforms, frames are warped on read
+    output_dtype="float64",  # dtype of registered frames, e.g. float32 or uint16 (rounded and clipped)
+    memory_budget=None,  # registered frames larger than this (bytes or e.g. "8G") go to a memmap
 ):
-    if transform.lower() == "affine":
-        tf = StackReg.AFFINE
-    elif transform.lower() == "rigid_body":
-        tf = StackReg.RIGID_BODY
-    else:
-        raise RuntimeError("Transform not recognized")
+    registered = _register_well(
+        img,
+        transform=transform,
+        well_name=well_name,
+        roi_channel=roi_channel,
+        experiment_type=experiment_type,
+        metadata=metadata,
+        nd2_file=nd2_file,
+        registration_downsample=registration_downsample,
+        registration_crop=registration_crop,
+        registration_threads=registration_threads,
+        compare_registration=compare_registration,
+        output_format=output_format,
+        save_registered_frames=save_registered_frames,
+        output_dtype=output_dtype,
+        memory_budget=memory_budget,
+    )
+    if registered is None:
+        return None
 
-    metadata = nd2_metadata_parse(img)
-    with nd2.ND2File(img) as f:
-        arr = f.asarray()
-    dim_names = list((metadata["dim_sizes"].keys()))
+    output_fname, data_dct, max_proj = registered
+    if mask_cache_dir == "default":
+        mask_cache_dir = os.path.join(os.path.dirname(output_fname), "_mask_cache")
+    data_dct["roi_masks"] = segment(
+        max_proj,
+        model_type=cellpose_model,
+        model_eval_kwargs=model_eval_kwargs,
+        cache_dir=mask_cache_dir,
+    )
+    data_dct["timing"] = timing_summary(current_span())
+    save_intermediate(output_fname, data_dct)
+
+
+def _register_well(
+    img,
+    transform="rigid_body",
+    well_name=None,
+    roi_channel=["FITC", "TRITC", "mCherry"],
+    experiment_type="timecourse",
+    metadata=None,
+    nd2_file=None,
+    registration_downsample=1,
+    registration_crop=None,
+    registration_threads=1,
+    compare_registration=False,
+    output_format="h5",
+    save_registered_frames=True,
+    output_dtype="float64",
+    memory_budget=None,
+):
+    tf = get_stackreg_transform(transform)
+
+    if metadata is None:
+        metadata = nd2_metadata_parse(img)
     phase_lens = metadata["phase_lens"]
     if well_name is not None:
         timesteps = metadata["timesteps"][well_name]
@@ -41,10 +114,12 @@ def register_and_get_rois(
 
     output_dir = os.path.join(os.path.dirname(img), "_analysis")
     sanitized_filename = os.path.join(output_dir, well_name)
-    output_fname = f"{sanitized_filename}.p"
+    output_fname = f"{sanitized_filename}.{output_format}"
 
-    if os.path.exists(output_fname):
-        print(f"Path exists: {output_fname}")
+    # don't redo wells that were registered with either the current or legacy format
+    existing_fname = find_intermediate(sanitized_filename)
+    if existing_fname is not None:
+        print(f"Path exists: {existing_fname}")
         return None
     else:
         os.makedirs(output_dir, exist_ok=True)
@@ -59,11 +134,7 @@ def register_and_get_rois(
         
     if use_roi_channel is None:
         print(f"Unable to process {img}: no channel names")
-        joblib.dump(
-            {},
-            output_fname,
-            compress="lz4",
-        )
+        save_intermediate(output_fname, {})
         return None
 
     well_scan = len(metadata["wells"]) > 0
@@ -78,6 +149,115 @@ def register_and_get_rois(
             np.unique(np.array([0] + phase_changes + [len(timesteps)]))
         )
 
+    phases = experiment_phases(phase_lens, experiment_type)
+    nchannels = len(metadata["channel_names"])
+
+    # if we find multiple positions in the file that means we're doing a well scan
+    event_table = metadata["event_table"]
+    phases_first_timestep = {}
+    if (
+        well_scan
+        and ("P Index" in event_table.columns)
+        and pd.notna(event_table["P Index"].iat[0])
+    ):
+        # phases are aligned to the timestamps of the first position
+        first_position_times = nd2_event_times(event_table, position_index=0)
+        for k, v in phases.items():
+            if v.start in first_position_times.index:
+                phases_first_timestep[k] = first_position_times.loc[v.start]
+    else:
+        for k, v in phases.items():
+            phases_first_timestep[k] = timesteps[v.start]
+
+    # only the requested well is ever read from disk, peak memory is bounded by one well
+    with nd2.ND2File(img) if nd2_file is None else nullcontext(nd2_file) as f:
+        arr, dim_names = nd2_well_view(f, well_name, metadata["wells"])
+
+        # if we can't find channels, assume it's single channel data
+        try:
+            arr_well_roi_channel = take_lazy(arr, use_roi_channel, axis=dim_names.index("C"))
+        except ValueError:
+            arr_well_roi_channel = arr
+
+        if arr_well_roi_channel.ndim != 3:
+            print(f"Unable to process {img}: not 3 dimensional data")
+            save_intermediate(output_fname, {})
+            return None
+
+        try:
+            nframes = len(arr_well_roi_channel)
+        except TypeError as e:
+            print(f"Unable to process {img}: bad array dimensions")
+            print(e)
+            save_intermediate(output_fname, {})
+            return None
+
+        with span("read_roi_channel") as record:
+            roi_stack = np.asarray(arr_well_roi_channel)
+            record_array(record, "roi_stack", roi_stack)
+        with span("estimate_transforms", downsample=registration_downsample):
+            tmats = estimate_transforms(
+                roi_stack, tf, downsample=registration_downsample, crop=registration_crop
+            )
+        if compare_registration:
+            registration_comparison = compare_transforms(roi_stack, tmats, tf)
+            print(f"Registration vs. full res for {well_name}: {registration_comparison}")
+        del roi_stack
+
+        # transform all channels, one channel is read at a time per thread
+        if "C" in dim_names:
+            channel_stacks = [
+                take_lazy(arr, i, axis=dim_names.index("C"))
+                for i in range(len(metadata["channel_names"]))
+            ]
+        else:
+            channel_stacks = [arr]
+
+        if save_registered_frames:
+            # preallocate once and warp each channel in place, chunk by chunk
+            data_reg = allocate_registered(
+                (len(channel_stacks),) + tuple(arr_well_roi_channel.shape),
+                dtype=output_dtype,
+                memory_budget=memory_budget,
+                tmp_dir=output_dir,
+            )
+            with span("transform_channels", threads=registration_threads) as record:
+                transform_channels(
+                    channel_stacks, tmats, tf, n_threads=registration_threads, out=data_reg
+                )
+                record_array(record, "registered_frames", data_reg)
+            max_proj = data_reg[use_roi_channel].max(axis=0)
+        else:
+            # only the roi channel is warped (for segmentation), the rest is re-derived
+            # from the raw file and the transforms when it's read
+            data_reg = None
+            with span("transform_channels", threads=1):
+                max_proj = transform_channels(
+                    [channel_stacks[min(use_roi_channel, len(channel_stacks) - 1)]], tmats, tf
+                )[0].max(axis=0)
+
+    data_dct = {
+        "registered_frames": data_reg,
+        "tmats": tmats,
+        "transform": transform.lower(),
+        "source_file": os.path.abspath(img),
+        "source_well": well_name,
+        "phases": phases,
+        "phases_first_timestep": phases_first_timestep,
+        "experiment_type": experiment_type,
+        "timesteps": timesteps,
+        "well_name": well_name,
+        "well_scan": well_scan,
+        "channels": metadata["channel_names"],
+        "events": metadata["events"],
+    }
+    if compare_registration:
+        data_dct["registration_comparison"] = registration_comparison
+    return output_fname, data_dct, max_proj
+
+
+def experiment_phases(phase_lens, experiment_type="timecourse"):
+    # consecutive frame ranges of the given lengths, named after the experiment type
     edge = 0
     steps = []
     for _phase_len in phase_lens:
@@ -92,94 +272,294 @@ def register_and_get_rois(
         phases = {f"pulse{i:02d}": _steps for i, _steps in enumerate(steps)}
     else:
         phases = {f"phase{i:02d}": _steps for i, _steps in enumerate(steps)}
-    nchannels = len(metadata["channel_names"])
+    return phases
 
-    # if we find multiple positions in the file that means we're doing a well scan
-    phases_first_timestep = {}
-    for k, v in phases.items():
-        if well_scan and ("P Index" in metadata["events"][0].keys()):
-            for _event in metadata["events"]:
-                if (
-                    ("P Index" in _event.keys())
-                    and ("T Index" in _event.keys())
-                    and (_event["P Index"] == 0)
-                    and (_event["T Index"] == v.start)
-                ):
-                    phases_first_timestep[k] = _event["Time [s]"]
-        else:
-            phases_first_timestep[k] = timesteps[v.start]
 
-    # if we can't find position, assume it's a single well
-    try:
-        use_well = metadata["wells"].index(well_name)
-        arr = arr.take(use_well, axis=dim_names.index("P"))
-        del [dim_names[dim_names.index("P")]]
-    except ValueError:
-        pass
-    
-    # if we can't find channels, assume it's single channel data
-    try:
-        arr_well_roi_channel = arr.take(use_roi_channel, axis=dim_names.index("C"))
-    except ValueError:
-        arr_well_roi_channel = arr
-
-    if arr_well_roi_channel.ndim != 3:
-        print(f"Unable to process {img}: not 3 dimensional data")
-        joblib.dump(
-            {},
-            output_fname,
-            compress="lz4",
-        )
-        return None
-        
-    try:
-        nframes = len(arr_well_roi_channel)
-    except TypeError as e:
-        print(f"Unable to process {img}: bad array dimensions")
-        print(e)
-        joblib.dump(
-            {},
-            output_fname,
-            compress="lz4",
-        )
-        return None
+def get_stackreg_transform(transform):
+    if transform.lower() == "affine":
+        return StackReg.AFFINE
+    elif transform.lower() == "rigid_body":
+        return StackReg.RIGID_BODY
+    else:
+        raise RuntimeError("Transform not recognized")
+
+
+def estimate_transforms(stack, tf=StackReg.RIGID_BODY, downsample=1, crop=None):
+    # estimate frame-to-frame transforms on a (optionally) cropped and block-averaged
+    # copy of the stack, then map the matrices back to full resolution pixel coordinates
+    if isinstance(tf, str):
+        tf = get_stackreg_transform(tf)
+    stack = _registration_view(stack, downsample, crop)
 
-    model = models.Cellpose(model_type=cellpose_model)
     sr = StackReg(tf)
-    tmats = sr.register_stack(
-        arr_well_roi_channel,
-        axis=0,
-        reference="previous",
-        verbose=False,
-    )
+    tmats = sr.register_stack(stack, axis=0, reference="previous", verbose=False)
+    if (downsample == 1) and (crop is None):
+        return tmats
+    scale_mat = _scale_matrix(downsample, crop)
+    return scale_mat @ tmats @ np.linalg.inv(scale_mat)
+
+
+class IncrementalRegistration:
+    # estimate_transforms one frame at a time for frames that are still being acquired.
+    # each frame is registered to the previous one and the transform composed with the
+    # previous frame's, the same as register_stack with reference="previous", so the
+    # cost per frame doesn't depend on how many frames came before
+    def __init__(self, transform="rigid_body", downsample=1, crop=None):
+        self.tf = get_stackreg_transform(transform) if isinstance(transform, str) else transform
+        self.downsample = downsample
+        self.crop = crop
+        self.scale_mat = _scale_matrix(downsample, crop)
+        self.tmat = np.identity(3)
+        self.previous = None
+        self._sr = StackReg(self.tf)
+
+    def update(self, frame):
+        # full resolution transform of the next (Y, X) frame
+        small = _registration_view(np.asarray(frame)[None], self.downsample, self.crop)[0]
+        if self.previous is not None:
+            self.tmat = self._sr.register(self.previous, small) @ self.tmat
+        self.previous = small
+        return self.scale_mat @ self.tmat @ np.linalg.inv(self.scale_mat)
+
+    def transform(self, frame, tmat):
+        return self._sr.transform(np.asarray(frame), tmat=tmat)
+
+
+def compare_transforms(stack, tmats, tf=StackReg.RIGID_BODY):
+    # accuracy of (downsampled/cropped) transforms against full resolution registration,
+    # reported as the displacement of the image corners in pixels
+    tmats_full = estimate_transforms(stack, tf)
+    height, width = stack.shape[1:]
+    corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]]).T
+    displacement = np.linalg.norm((tmats @ corners - tmats_full @ corners)[:, :2], axis=1)
+    return {
+        "mean_corner_error": float(displacement.mean()),
+        "max_corner_error": float(displacement.max()),
+    }
+
+
+def transform_channels(
+    channel_stacks, tmats, tf=StackReg.RIGID_BODY, n_threads=1, out=None, chunk_size=64
+):
+    # apply the same transforms to every channel, channels can be lazy (read on demand).
+    # if out is given, frames are warped chunk_size at a time and written into it in place
+    # (cast to out.dtype), so float64 copies never exceed one chunk per thread
+    if isinstance(tf, str):
+        tf = get_stackreg_transform(tf)
+
+    def _transform(stack):
+        return StackReg(tf).transform_stack(np.asarray(stack), axis=0, tmats=tmats)
+
+    def _transform_into(i):
+        sr = StackReg(tf)
+        for _start in range(0, len(tmats), chunk_size):
+            _stop = min(_start + chunk_size, len(tmats))
+            warped = sr.transform_stack(
+                np.asarray(channel_stacks[i][_start:_stop]), axis=0, tmats=tmats[_start:_stop]
+            )
+            out[i, _start:_stop] = cast_frames(warped, out.dtype)
+
+    if out is None:
+        func, items = _transform, channel_stacks
+    else:
+        func, items = _transform_into, range(len(channel_stacks))
+
+    if n_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results = list(executor.map(func, items))
+    else:
+        results = [func(_item) for _item in items]
+    return results if out is None else out
+
+
+def allocate_registered(shape, dtype="float64", memory_budget=None, tmp_dir=None):
+    # registered output for all channels, backed by an (anonymous) temporary file
+    # instead of RAM when it would exceed the memory budget
+    dtype = np.dtype(dtype)
+    memory_budget = parse_size(memory_budget)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if (memory_budget is not None) and (nbytes > memory_budget):
+        # unlinked on close, the mapping keeps the data alive until it's garbage collected
+        with tempfile.TemporaryFile(dir=tmp_dir) as f:
+            return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+    return np.empty(shape, dtype=dtype)
+
+
+def cast_frames(frames, dtype):
+    # float -> integer output is rounded and clipped to the range of the dtype
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(frames), info.min, info.max).astype(dtype)
+    return frames.astype(dtype, copy=False)
+
+
+class RegisteredView:
+    # read-only (T, Y, X) view of one channel of the raw ND2 file, frames are read and
+    # warped with the stored transforms only when they are indexed
+    dtype = np.dtype("float64")
+    ndim = 3
+
+    def __init__(self, nd2_path, tmats, transform="rigid_body", well_name=None, channel=None):
+        self.nd2_path = nd2_path
+        self.tmats = np.asarray(tmats)
+        self.transform = transform
+        self.well_name = well_name
+        self.channel = channel
+        self._file = None
+        self._arr = None
+
+    def _raw(self):
+        if self._arr is None:
+            self._file = nd2.ND2File(self.nd2_path)
+            arr, dim_names = nd2_well_view(
+                self._file, self.well_name, nd2_well_names(self._file)
+            )
+            if ("C" in dim_names) and (self.channel is not None):
+                arr = take_lazy(arr, self.channel, axis=dim_names.index("C"))
+            self._arr = arr
+        return self._arr
+
+    @property
+    def shape(self):
+        return (len(self.tmats),) + tuple(self._raw().shape[-2:])
+
+    def __len__(self):
+        return len(self.tmats)
 
-    # transform all channels...
-    # register_stack stores transformation matrices in self.tmats
-    # these are then used to register the data...
-    data_reg = []
-    if "C" in dim_names:
-        for i, _channel in enumerate(metadata["channel_names"]):
-            data_reg.append(sr.transform_stack(arr.take(i, axis=dim_names.index("C"))))
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, other_keys = key[0], key[1:]
+        if isinstance(frame_key, range):
+            frame_key = slice(frame_key.start, frame_key.stop, frame_key.step)
+
+        frames = np.arange(len(self))[frame_key]
+        single_frame = np.ndim(frames) == 0
+        frames = np.atleast_1d(frames)
+        if isinstance(frame_key, slice):
+            raw = np.asarray(self._raw()[frame_key])
+        else:
+            raw = np.asarray(self._raw()[frames])
+
+        sr = StackReg(get_stackreg_transform(self.transform))
+        warped = sr.transform_stack(raw, axis=0, tmats=self.tmats[frames])
+        if single_frame:
+            warped = warped[0]
+        if len(other_keys) > 0:
+            warped = warped[(slice(None),) * (not single_frame) + other_keys]
+        return warped
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def iter_chunks(self, chunk_size=64):
+        for _start in range(0, len(self), chunk_size):
+            yield _start, self[_start : _start + chunk_size]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._arr = None
+
+    def __getstate__(self):
+        # open file handles don't survive pickling (e.g. to worker processes)
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_arr"] = None
+        return state
+
+
+def register_plate(img, n_jobs=1, wells=None, **kwargs):
+    # process every well of a well-scan file in a single pass, metadata is parsed once
+    # and each worker opens the file once and segments its wells in batches
+    metadata = nd2_metadata_parse(img)
+    if wells is None:
+        wells = metadata["wells"]
+
+    # not a well scan, nothing to fan out
+    if len(wells) == 0:
+        kwargs.pop("segment_batch_size", None)
+        return register_and_get_rois(img, metadata=metadata, **kwargs)
+
+    n_jobs = min(n_jobs, len(wells))
+    well_chunks = [wells[i::n_jobs] for i in range(n_jobs)]
+    if n_jobs == 1:
+        _register_wells(img, wells, metadata, **kwargs)
     else:
-        data_reg.append(sr.transform_stack(arr))
-    data_reg = np.array(data_reg)
-
-    max_proj = data_reg[use_roi_channel].max(axis=0)
-    masks, _, _, _ = model.eval(max_proj, **model_eval_kwargs)
-
-    joblib.dump(
-        {
-            "registered_frames": data_reg,
-            "roi_masks": masks,
-            "phases": phases,
-            "phases_first_timestep": phases_first_timestep,
-            "experiment_type": experiment_type,
-            "timesteps": timesteps,
-            "well_name": well_name,
-            "well_scan": well_scan,
-            "channels": metadata["channel_names"],
-            "events": metadata["events"],
-        },
-        output_fname,
-        compress="lz4",
-    )
\ No newline at end of file
+        joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_register_wells)(img, _chunk, metadata, **kwargs)
+            for _chunk in well_chunks
+        )
+
+
+def _register_wells(
+    img,
+    wells,
+    metadata,
+    cellpose_model="cyto2",
+    model_eval_kwargs=model_eval_kwargs,
+    mask_cache_dir="default",
+    segment_batch_size=1,  # number of registered wells held in memory for one model.eval call
+    **kwargs,
+):
+    with nd2.ND2File(img) as f:
+        for i in range(0, len(wells), segment_batch_size):
+            registered = []
+            well_spans = []
+            for _well in wells[i : i + segment_batch_size]:
+                with span("register_well", well=_well) as record:
+                    _registered = _register_well(
+                        img, well_name=_well, metadata=metadata, nd2_file=f, **kwargs
+                    )
+                if _registered is not None:
+                    registered.append(_registered)
+                    well_spans.append(record)
+            if len(registered) == 0:
+                continue
+
+            if mask_cache_dir == "default":
+                use_mask_cache_dir = os.path.join(os.path.dirname(registered[0][0]), "_mask_cache")
+            else:
+                use_mask_cache_dir = mask_cache_dir
+            # the batch's segmentation span goes into the timing summary of each of its wells
+            with span("segment_batch", wells=len(registered)) as segment_record:
+                masks = segment(
+                    [_max_proj for _, _, _max_proj in registered],
+                    model_type=cellpose_model,
+                    model_eval_kwargs=model_eval_kwargs,
+                    cache_dir=use_mask_cache_dir,
+                )
+            for (_output_fname, _data_dct, _), _masks, _record in zip(registered, masks, well_spans):
+                _data_dct["roi_masks"] = _masks
+                _data_dct["timing"] = timing_summary([_record, segment_record])
+                save_intermediate(_output_fname, _data_dct)
+
+
+def _registration_view(stack, downsample=1, crop=None):
+    # (optionally) cropped and block-averaged copy of a stack to estimate transforms on
+    if crop is not None:
+        y0, y1, x0, x1 = crop
+        stack = stack[:, y0:y1, x0:x1]
+    if downsample > 1:
+        from skimage.transform import downscale_local_mean
+
+        stack = downscale_local_mean(stack, (1, downsample, downsample))
+    return stack
+
+
+def _scale_matrix(downsample=1, crop=None):
+    # maps (x, y) in the small stack to (x, y) in the full stack,
+    # a block average puts each small pixel at the center of its block
+    y0, x0 = (0, 0) if crop is None else (crop[0], crop[2])
+    offset = (downsample - 1) / 2
+    return np.array(
+        [
+            [downsample, 0, x0 + offset],
+            [0, downsample, y0 + offset],
+            [0, 0, 1],
+        ]
+    )
@@ -0,0 +1,71 @@
+import os
+import json
+import hashlib
+import numpy as np
+from calcium_imaging_analysis.instrument import span, current_span
+
+# loaded cellpose models, one per model type and process
+_models = {}
+
+
+def get_model(model_type="cyto2", **kwargs):
+    # model construction (and torch init) costs more than segmenting a single
+    # image on CPU, so hold on to every model we build for the life of the process
+    key = (model_type, json.dumps(kwargs, sort_keys=True, default=str))
+    if key not in _models:
+        from cellpose import models
+
+        _models[key] = models.Cellpose(model_type=model_type, **kwargs)
+    return _models[key]
+
+
+def projection_hash(projection, model_type, model_eval_kwargs):
+    # key for the mask cache, changes with the image content or any segmentation parameter
+    projection = np.ascontiguousarray(projection)
+    h = hashlib.sha1()
+    h.update(f"{projection.shape}{projection.dtype.str}".encode())
+    h.update(projection.tobytes())
+    h.update(
+        json.dumps(
+            {"model_type": model_type, **model_eval_kwargs}, sort_keys=True, default=str
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+@span("segmentation")
+def segment(projections, model_type="cyto2", model_eval_kwargs={}, cache_dir=None):
+    # segment one projection or a batch of projections with a single model.eval call,
+    # masks are cached in cache_dir so unchanged inputs are never segmented twice
+    single = isinstance(projections, np.ndarray) and (projections.ndim == 2)
+    if single:
+        projections = [projections]
+
+    masks = [None] * len(projections)
+    cache_fnames = [None] * len(projections)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for i, _proj in enumerate(projections):
+            cache_fnames[i] = os.path.join(
+                cache_dir, f"{projection_hash(_proj, model_type, model_eval_kwargs)}.npy"
+            )
+            try:
+                masks[i] = np.load(cache_fnames[i])
+            except (FileNotFoundError, ValueError, OSError):
+                pass
+
+    todo = [i for i, _mask in enumerate(masks) if _mask is None]
+    current_span()["images"] = len(projections)
+    current_span()["cached"] = len(projections) - len(todo)
+    if len(todo) > 0:
+        model = get_model(model_type)
+        new_masks, _, _, _ = model.eval([projections[i] for i in todo], **model_eval_kwargs)
+        for i, _mask in zip(todo, new_masks):
+            masks[i] = _mask
+            if cache_fnames[i] is not None:
+                np.save(cache_fnames[i], _mask)
+
+    if single:
+        return masks[0]
+    else:
+        return masks
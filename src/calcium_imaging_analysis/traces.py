@@ -0,0 +1,312 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def roi_pixel_index(masks):
+    # compact pixel index for every ROI in a label image, computed once and reused for
+    # every frame. pixels are grouped by label (ascending, same order as regionprops)
+    # and kept in raster order within each label
+    flat_masks = np.asarray(masks).ravel()
+    pixels = np.flatnonzero(flat_masks)
+    labels = flat_masks[pixels]
+    order = np.argsort(labels, kind="stable")
+    pixels = pixels[order]
+    labels, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    return {
+        "labels": labels,
+        "pixels": pixels,
+        "starts": starts,
+        "counts": counts,
+        "shape": flat_masks.shape,
+    }
+
+
+def roi_means(frames, roi_index, chunk_size=256):
+    # mean intensity of every ROI in every frame of a (T, Y, X) stack, returns (T, ROI).
+    # frames only need to support len() and slicing, so memmaps, h5py datasets
+    # and dask arrays are read chunk_size frames at a time
+    if isinstance(roi_index, np.ndarray):
+        roi_index = roi_pixel_index(roi_index)
+    nframes = len(frames)
+    nrois = len(roi_index["labels"])
+    means = np.empty((nframes, nrois), dtype="float64")
+    for _start in range(0, nframes, chunk_size):
+        _stop = min(_start + chunk_size, nframes)
+        chunk = np.asarray(frames[_start:_stop])
+        roi_pixels = chunk.reshape(len(chunk), -1)[:, roi_index["pixels"]]
+        for i, (_roi_start, _count) in enumerate(zip(roi_index["starts"], roi_index["counts"])):
+            # contiguous copy so each row is summed pairwise exactly like regionprops does
+            means[_start:_stop, i] = np.ascontiguousarray(
+                roi_pixels[:, _roi_start : _roi_start + _count]
+            ).mean(axis=1)
+    return means
+
+
+# column roles in the long trace layout written by proc_photoswitch/proc_photobleach
+frame_columns = ["phase", "t", "t_align", "frame_number"]
+attr_columns = ["well", "well_sanitized", "filename"]
+roi_columns = ["value_aux"]
+metadata_key = b"calcium_imaging_analysis"
+
+
+def phase_frames(t, phases={}, phases_first_timestep={}):
+    # per-frame phase, t and t_align columns. with phases only frames inside a phase are
+    # kept and t_align counts from that phase's first timestep, otherwise every frame is
+    # kept and t_align counts from the first frame. later phases win where ranges overlap
+    t = np.asarray(t, dtype="float64")
+    nframes = len(t)
+    if len(phases) == 0:
+        return pd.DataFrame(
+            {
+                "phase": np.full(nframes, "n/a", dtype=object),
+                "t": t,
+                "t_align": t - t[0] if nframes > 0 else t,
+                "frame_number": np.arange(nframes),
+            }
+        )
+
+    phase_names = np.array(list(phases.keys()), dtype=object)
+    phase_idx = np.full(nframes, -1)
+    for i, _range in enumerate(phases.values()):
+        if isinstance(_range, range):
+            phase_idx[_range.start : _range.stop : _range.step] = i
+        else:
+            _range = np.asarray(_range, dtype="int64")
+            phase_idx[_range[(_range >= 0) & (_range < nframes)]] = i
+    first_timestep = np.array(
+        [phases_first_timestep.get(_name, np.nan) for _name in phase_names], dtype="float64"
+    )
+
+    frame_number = np.flatnonzero(phase_idx >= 0)
+    phase_idx = phase_idx[frame_number]
+    return pd.DataFrame(
+        {
+            "phase": phase_names[phase_idx],
+            "t": t[frame_number],
+            "t_align": t[frame_number] - first_timestep[phase_idx],
+            "frame_number": frame_number,
+        }
+    )
+
+
+def build_traces(frames, values):
+    # long (frame x roi) table from phase_frames and the matching (T, ROI) matrix
+    return wide_to_long(wide_traces(frames, {"value": values}), categorical=False)
+
+
+def wide_traces(frames, values, attrs={}, rois={}):
+    # wide trace dict (see long_to_wide) straight from phase_frames, the (T, ROI) matrix of
+    # every value column, the per-file constants and the per-ROI columns. the long layout
+    # keeps the column order proc_* always had: frames, roi, value, attrs, other values, rois
+    values = {_col: np.asarray(_values) for _col, _values in values.items()}
+    nrois = next(iter(values.values())).shape[1]
+    value_columns = sorted(values, key=lambda _col: _col != "value")
+    return {
+        "frames": frames,
+        "values": {_col: values[_col] for _col in value_columns},
+        "rois": pd.DataFrame({"roi": np.arange(nrois), **rois}),
+        "attrs": dict(attrs),
+        "columns": list(frames.columns)
+        + ["roi"]
+        + value_columns[:1]
+        + list(attrs)
+        + value_columns[1:]
+        + list(rois),
+    }
+
+
+def long_to_wide(traces):
+    # split a long (frame x roi) trace table into a per-frame table, one (T, ROI) matrix
+    # per value column, a per-ROI table and the per-file constants
+    use_frame_columns = [_col for _col in frame_columns if _col in traces.columns]
+    use_attr_columns = [_col for _col in attr_columns if _col in traces.columns]
+    use_roi_columns = [_col for _col in roi_columns if _col in traces.columns]
+    value_columns = [
+        _col
+        for _col in traces.columns
+        if _col not in use_frame_columns + use_attr_columns + use_roi_columns + ["roi"]
+    ]
+
+    frames = (
+        traces.drop_duplicates("frame_number")[use_frame_columns]
+        .sort_values("frame_number")
+        .reset_index(drop=True)
+    )
+    rois = (
+        traces.drop_duplicates("roi")[["roi"] + use_roi_columns]
+        .sort_values("roi")
+        .reset_index(drop=True)
+    )
+    rois["roi"] = rois["roi"].astype("int64")
+
+    frame_idx = np.searchsorted(frames["frame_number"].to_numpy(), traces["frame_number"].to_numpy())
+    roi_idx = np.searchsorted(rois["roi"].to_numpy(), traces["roi"].to_numpy(dtype="int64"))
+    values = {}
+    for _col in value_columns:
+        values[_col] = np.full((len(frames), len(rois)), np.nan)
+        values[_col][frame_idx, roi_idx] = traces[_col].to_numpy()
+
+    attrs = {_col: traces[_col].iat[0] if len(traces) > 0 else None for _col in use_attr_columns}
+    return {
+        "frames": frames,
+        "values": values,
+        "rois": rois,
+        "attrs": attrs,
+        "columns": list(traces.columns),
+    }
+
+
+def wide_to_long(wide, categorical=True):
+    # inverse of long_to_wide, rows are ordered roi by roi like DataFrame.melt.
+    # with categorical=True strings are categoricals, values float32 and ints 32 bit,
+    # compacted before they're expanded so the full table is only built once
+    nframes = len(wide["frames"])
+    nrois = len(wide["rois"])
+    columns = {}
+    for _col in wide["frames"].columns:
+        columns[_col] = _long_column(_col, wide["frames"][_col].to_numpy(), np.tile, nrois, categorical)
+    columns["roi"] = _long_column("roi", wide["rois"]["roi"].to_numpy(), np.repeat, nframes, categorical)
+    for _col, _values in wide["values"].items():
+        _values = np.asarray(_values).T
+        if categorical and (_values.dtype.kind == "f"):
+            _values = _values.astype("float32")
+        columns[_col] = _values.ravel()
+    for _col, _value in wide["attrs"].items():
+        columns[_col] = _long_column(
+            _col, np.array([_value], dtype=object), np.repeat, nframes * nrois, categorical
+        )
+    for _col in wide["rois"].columns.drop("roi"):
+        columns[_col] = _long_column(_col, wide["rois"][_col].to_numpy(), np.repeat, nframes, categorical)
+
+    traces = pd.DataFrame({_col: columns[_col] for _col in wide["columns"] if _col in columns})
+    if not categorical:
+        for _col in wide["values"]:
+            traces[_col] = traces[_col].astype("float64")
+        traces["roi"] = traces["roi"].astype("int64")
+        for _col in list(wide["attrs"]) + ["phase"]:
+            if _col in traces.columns:
+                traces[_col] = traces[_col].astype(str)
+    return traces
+
+
+def compact_traces(traces, value_dtype="float32"):
+    # dictionary-encode the repeated strings and shrink numeric columns
+    traces = traces.copy()
+    for _col in traces.columns:
+        if _col in frame_columns + attr_columns:
+            if not pd.api.types.is_numeric_dtype(traces[_col]):
+                traces[_col] = traces[_col].astype("category")
+                continue
+        if _col in ("roi", "frame_number"):
+            traces[_col] = traces[_col].astype("int32")
+        elif _col not in ("t", "t_align") and pd.api.types.is_float_dtype(traces[_col]):
+            traces[_col] = traces[_col].astype(value_dtype)
+    return traces
+
+
+def write_traces(traces, fname, layout="wide", value_dtype="float32", metadata={}):
+    # wide: per-frame columns plus one <value>/<roi> column per value and ROI,
+    # per-ROI and per-file data go in the parquet schema metadata.
+    # long: the melted layout with categorical strings.
+    # metadata (e.g. the timing summary) is stored in the schema metadata of either layout.
+    # traces can be long or the wide dict, wide is written without going through long
+    if layout == "long":
+        if isinstance(traces, dict):
+            traces = wide_to_long(traces, categorical=False)
+        table = pa.Table.from_pandas(compact_traces(traces, value_dtype=value_dtype))
+        if len(metadata) > 0:
+            table = table.replace_schema_metadata(
+                {**(table.schema.metadata or {}), metadata_key: json.dumps(metadata).encode()}
+            )
+        pq.write_table(table, fname)
+        return
+
+    wide = traces if isinstance(traces, dict) else long_to_wide(traces)
+    table = wide["frames"].copy()
+    value_table = pd.DataFrame(
+        {
+            f"{_name}/{_roi}": np.asarray(_values[:, i], dtype=value_dtype)
+            for _name, _values in wide["values"].items()
+            for i, _roi in enumerate(wide["rois"]["roi"])
+        },
+        index=table.index,
+    )
+    table = pd.concat([table, value_table], axis=1)
+    if "phase" in table.columns:
+        table["phase"] = table["phase"].astype("category")
+
+    metadata = {
+        **metadata,
+        "layout": "wide",
+        "attrs": {k: _to_json(v) for k, v in wide["attrs"].items()},
+        "rois": {_col: wide["rois"][_col].tolist() for _col in wide["rois"].columns},
+        "values": list(wide["values"].keys()),
+        "columns": wide["columns"],
+    }
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    arrow_table = arrow_table.replace_schema_metadata(
+        {**(arrow_table.schema.metadata or {}), metadata_key: json.dumps(metadata).encode()}
+    )
+    pq.write_table(arrow_table, fname)
+
+
+def read_traces(fname, layout="long", categorical=True, columns=None):
+    # read traces written by write_traces (or plain long parquet files from older versions).
+    # layout="long" returns the melted DataFrame proc_* used to return, layout="wide"
+    # the dict from long_to_wide. columns restricts which value columns are read
+    schema = pq.read_schema(fname)
+    metadata = json.loads((schema.metadata or {}).get(metadata_key, b"{}"))
+    if metadata.get("layout") != "wide":
+        traces = pd.read_parquet(fname, columns=columns)
+        if layout == "wide":
+            return long_to_wide(traces)
+        return compact_traces(traces) if categorical else traces
+
+    value_names = metadata["values"] if columns is None else [_ for _ in metadata["values"] if _ in columns]
+    rois = pd.DataFrame(metadata["rois"])
+    read_columns = [_col for _col in frame_columns if _col in schema.names] + [
+        f"{_name}/{_roi}" for _name in value_names for _roi in rois["roi"]
+    ]
+    table = pd.read_parquet(fname, columns=read_columns)
+    frames = table[[_col for _col in frame_columns if _col in table.columns]]
+    if "phase" in frames.columns:
+        frames = frames.assign(phase=frames["phase"].astype(str))
+    wide = {
+        "frames": frames,
+        "values": {
+            _name: table[[f"{_name}/{_roi}" for _roi in rois["roi"]]].to_numpy()
+            for _name in value_names
+        },
+        "rois": rois,
+        "attrs": metadata["attrs"],
+        "columns": [
+            _col
+            for _col in metadata["columns"]
+            if (_col not in metadata["values"]) or (_col in value_names)
+        ],
+    }
+    if layout == "wide":
+        return wide
+    return wide_to_long(wide, categorical=categorical)
+
+
+def _long_column(col, values, expand, reps, categorical):
+    # one long column from its per-frame, per-ROI or per-file values (expand is np.tile or
+    # np.repeat), with categorical=True compacted like compact_traces does before expanding
+    if reps == 0:
+        values = values[:0]
+    if categorical:
+        values = compact_traces(pd.DataFrame({col: values}))[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return pd.Categorical.from_codes(
+                expand(values.cat.codes.to_numpy(), reps), dtype=values.dtype
+            )
+        values = values.to_numpy()
+    return expand(values, reps)
+
+
+def _to_json(value):
+    return value.item() if isinstance(value, np.generic) else value
@@ -13,6 +13,149 @@ label_cmap = ListedColormap(rng.random(size=(50, 3)))
 label_cmap.set_bad([0, 0, 0])
 
 
+def _iter_frames(dat, chunk_size=64):
+    # chunk_size frames at a time, works for arrays, memmaps, h5py datasets and lazy views
+    for _, _chunk in _iter_chunks(dat, chunk_size):
+        yield _chunk
+
+
+def _iter_chunks(dat, chunk_size=64):
+    for _start in range(0, len(dat), chunk_size):
+        yield _start, np.asarray(dat[_start : _start + chunk_size])
+
+
+def stack_max(dat, chunk_size=64):
+    # max projection of a (T, Y, X) stack without loading it all at once
+    max_proj = None
+    for _chunk in _iter_frames(dat, chunk_size):
+        _chunk_max = _chunk.max(axis=0)
+        max_proj = _chunk_max if max_proj is None else np.maximum(max_proj, _chunk_max)
+    return max_proj
+
+
+def stack_quantiles(dat, quantiles=[0.025, 0.995], bins=2**20, chunk_size=64, max_refine=2**24, exact=None):
+    return stack_stats(
+        dat,
+        quantiles,
+        bins=bins,
+        chunk_size=chunk_size,
+        max_refine=max_refine,
+        exact=exact,
+    )[0]
+
+
+def stack_stats(
+    dat,
+    quantiles=[0.025, 0.995],
+    bins=2**20,
+    chunk_size=64,
+    max_refine=2**24,
+    exact=None,  # default exact for in-memory arrays only
+    on_chunk=None,  # on_chunk(start, chunk) for every chunk, e.g. to extract ROI means
+):
+    # quantiles of every pixel in a stack and its max projection from a single chunked
+    # pass, memory is one chunk plus the histogram. 8/16 bit integer stacks are counted
+    # exactly. other values are counted by the top log2(bins) bits of their order-preserving
+    # float32 bit pattern, so no pass is needed to find the range first and the relative
+    # error is below 2 ** (9 - log2(bins)) (0.05% for 2**20 bins). with exact=True a second
+    # pass keeps only the values in the bins holding the requested order statistics, so the
+    # result matches np.nanquantile. that pass re-reads (and for lazy registered views
+    # re-warps) the stack, so it's skipped unless dat is in memory, or if those bins hold
+    # more than max_refine values
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype="float64"))
+    dtype = np.dtype(getattr(dat, "dtype", np.asarray(dat[:1]).dtype))
+    small_int = (dtype.kind in "ui") and (dtype.itemsize <= 2)
+    if small_int:
+        lo = int(np.iinfo(dtype).min)
+        counts = np.zeros(int(np.iinfo(dtype).max) - lo + 1, dtype="int64")
+    else:
+        nbits = int(np.clip(np.log2(bins), 9, 32))
+        counts = np.zeros(2**nbits, dtype="int64")
+
+    max_proj = None
+    for _start, _chunk in _iter_chunks(dat, chunk_size):
+        if on_chunk is not None:
+            on_chunk(_start, _chunk)
+        _chunk_max = _chunk.max(axis=0)
+        max_proj = _chunk_max if max_proj is None else np.maximum(max_proj, _chunk_max)
+        if small_int:
+            counts += np.bincount(_chunk.ravel().astype("int64") - lo, minlength=len(counts))
+        else:
+            counts += np.bincount(_float_keys(_valid(_chunk), nbits), minlength=len(counts))
+
+    cum_counts = np.cumsum(counts)
+    if (len(quantiles) == 0) or (cum_counts[-1] == 0):
+        return np.full(len(quantiles), np.nan), max_proj
+    order_stats, frac = _order_stats(cum_counts[-1], quantiles)
+    stat_bins = np.searchsorted(cum_counts, order_stats, side="right")
+    if small_int:
+        values = (stat_bins + lo).astype("float64")
+        values = values.reshape(2, -1)
+        return values[0] + (values[1] - values[0]) * frac, max_proj
+
+    before = cum_counts - counts
+    use_bins = np.unique(stat_bins)
+    if exact is None:
+        exact = isinstance(dat, np.ndarray) and not isinstance(dat, np.memmap)
+    if exact and (counts[use_bins].sum() <= max_refine):
+        # sort the values falling in the bins we need
+        in_bins = {_bin: [] for _bin in use_bins}
+        for _, _chunk in _iter_chunks(dat, chunk_size):
+            _values = _valid(_chunk)
+            _keys = _float_keys(_values, nbits)
+            _selected = np.isin(_keys, use_bins)
+            _values, _keys = _values[_selected], _keys[_selected]
+            for _bin in use_bins:
+                in_bins[_bin].append(_values[_keys == _bin])
+        in_bins = {_bin: np.sort(np.concatenate(_values)) for _bin, _values in in_bins.items()}
+        values = np.array(
+            [in_bins[_bin][_stat - before[_bin]] for _bin, _stat in zip(stat_bins, order_stats)],
+            dtype="float64",
+        )
+    else:
+        # spread each bin's values evenly between its edges, within a bin the mantissa
+        # (and so the value) is linear in the bit pattern
+        lower, upper = _key_edges(stat_bins, nbits)
+        values = lower + (upper - lower) * (order_stats - before[stat_bins] + 0.5) / counts[stat_bins]
+
+    values = values.reshape(2, -1)
+    return values[0] + (values[1] - values[0]) * frac, max_proj
+
+
+def _order_stats(n, quantiles):
+    # 0-based order statistics either side of each quantile (linear interpolation, like
+    # np.quantile), stacked as [lower..., upper...], and the fraction between them
+    rank = quantiles * (n - 1)
+    lower = np.floor(rank).astype("int64")
+    upper = np.minimum(lower + 1, n - 1)
+    return np.concatenate([lower, upper]), rank - lower
+
+
+def _valid(chunk):
+    values = chunk.ravel()
+    return values[~np.isnan(values)]
+
+
+def _float_keys(values, nbits):
+    # top nbits of the float32 bit pattern, flipped so keys sort like the values
+    bits = np.asarray(values, dtype="float32").view("uint32")
+    bits = np.where(bits & 0x80000000, ~bits, bits | 0x80000000)
+    return (bits >> (32 - nbits)).astype("intp")
+
+
+def _key_edges(keys, nbits):
+    # smallest and largest float32 value with each key
+    low_bits = np.uint32(2 ** (32 - nbits) - 1)
+    edges = []
+    for _bits in (
+        keys.astype("uint32") << np.uint32(32 - nbits),
+        (keys.astype("uint32") << np.uint32(32 - nbits)) | low_bits,
+    ):
+        _bits = np.where(_bits & 0x80000000, _bits & 0x7FFFFFFF, ~_bits).astype("uint32")
+        edges.append(_bits.view("float32").astype("float64"))
+    return edges
+
+
 def show_segmentation(
     dat, masks, clims=None, fluo_cmap=fluo_cmap_red, label_cmap=label_cmap
 ):
@@ -24,7 +167,7 @@ def show_segmentation(
             fluo_cmap = fluo_cmap_green
 
     if clims is None:
-        clims = np.quantile(dat, [0.025, 0.995])
+        clims = stack_quantiles(dat[None], [0.025, 0.995])
     fig, ax = plt.subplots(1, 2, figsize=(6, 3), sharex=True, sharey=True)
     masks_plt = masks.copy().astype("float")
     masks_plt[masks_plt == 0] = np.nan
@@ -49,27 +192,46 @@ def show_segmentation(
 #     ax.set_xlabel("Time (frames)")
 #     return fig, ax
 
-def plot_trace(dat, x="t", y="value", phases=None, ylabel=None, exclude_first_points=False):
+def plot_trace(
+    dat,
+    x="t",
+    y="value",
+    phases=None,
+    ylabel=None,
+    exclude_first_points=False,
+    summary=False,  # draw mean and band computed in numpy instead of seaborn's bootstrap
+    band="sem",  # summary band, "sem" or a pair of percentiles e.g. (2.5, 97.5)
+):
     # mark the beginning of each phase with a vertical line...
     # EXCLUDE first point of phase as an option
-    import seaborn as sns
     fig, ax = plt.subplots(1, figsize=(4, 2))
-    plt_dat = dat.copy()
-    
+
+    # time of each phase's first frame, looked up by frame number
     first_points = []
     if phases is not None:
+        frame_numbers, first_rows = np.unique(dat["frame_number"].to_numpy(), return_index=True)
+        frame_t = dat["t"].to_numpy()[first_rows]
         for frames in phases.values():
-            frame_lst = list(frames)
-            try:
-                first_points.append(plt_dat.loc[plt_dat["frame_number"]==min(frame_lst), "t"].iloc[0])
-            except IndexError:
-                pass
-            # t = dat.loc[dat["frame_number"]==frame_lst[0], "t"].iloc[0]
-            # ax.axvline(t, alpha=.5) # mark the beginning of each phase..
-    
+            if len(frames) == 0:
+                continue
+            first_frame = min(frames)
+            idx = np.searchsorted(frame_numbers, first_frame)
+            if (idx < len(frame_numbers)) and (frame_numbers[idx] == first_frame):
+                first_points.append(frame_t[idx])
+
+    x_values = dat[x].to_numpy()
+    y_values = dat[y].to_numpy(dtype="float64")
     if exclude_first_points:
-        plt_dat.loc[plt_dat["t"].isin(first_points), y] = np.nan
-    sns.lineplot(plt_dat, x=x, y=y, ax=ax)
+        y_values = np.where(np.isin(dat["t"].to_numpy(), first_points), np.nan, y_values)
+
+    if summary:
+        x_summary, mean, lower, upper = summarize_trace(x_values, y_values, band=band)
+        line = ax.plot(x_summary, mean)[0]
+        ax.fill_between(x_summary, lower, upper, color=line.get_color(), alpha=0.2, linewidth=0)
+    else:
+        import seaborn as sns
+
+        sns.lineplot(x=x_values, y=y_values, ax=ax)
     for _point in first_points:
         ax.axvline(_point, alpha=.3) 
     if ylabel is None:
@@ -77,4 +239,29 @@ def plot_trace(dat, x="t", y="value", phases=None, ylabel=None, exclude_first_po
     else:
         ax.set_ylabel(ylabel)
     ax.set_xlabel("Time (frames)")
-    return fig, ax
\ No newline at end of file
+    return fig, ax
+
+
+def summarize_trace(x, y, band="sem"):
+    # mean and a band of y at every unique x, NaNs ignored. band is "sem" (mean +/- SEM)
+    # or a pair of percentiles, computed for all x at once from one sort
+    keep = ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    x_summary, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    mean = np.bincount(inverse, weights=y) / counts
+    if band == "sem":
+        sq_dev = np.bincount(inverse, weights=(y - mean[inverse]) ** 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sem = np.sqrt(sq_dev / (counts - 1)) / np.sqrt(counts)
+        return x_summary, mean, mean - sem, mean + sem
+
+    # sorted by x then y, each x's values are a contiguous run
+    y_sorted = y[np.lexsort((y, inverse))]
+    starts = np.cumsum(counts) - counts
+    bands = []
+    for _percentile in band:
+        rank = starts + (_percentile / 100) * (counts - 1)
+        lower = np.floor(rank).astype("int64")
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        bands.append(y_sorted[lower] + (y_sorted[upper] - y_sorted[lower]) * (rank - lower))
+    return x_summary, mean, bands[0], bands[1]